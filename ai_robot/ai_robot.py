@@ -1,5 +1,7 @@
+import threading
+import time
 from itertools import combinations, product
-from typing import Dict, Iterable, List, Tuple
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
 
 import numpy
 import numpy as np
@@ -11,6 +13,8 @@ from image_extraction.grid_extraction import (get_bot_location,
 
 from image_extraction.Color import Color, revert_color_value
 from image_extraction.Wall import Wall
+from tools.instrumentation import count_level
+from tools.VisitedTable import VisitedTable
 
 
 def transform_grid(grid: np.ndarray) -> np.ndarray:
@@ -52,6 +56,25 @@ BOTTOM_RANK = int(Wall.BOTTOM.rank())
 LEFT_RANK = int(Wall.LEFT.rank())
 RIGHT_RANK = int(Wall.RIGHT.rank())
 
+GRID_SIZE = 16
+ROBOT_BITS = 8
+ROBOT_MASK = (1 << ROBOT_BITS) - 1
+
+# offset of the case index when moving by one case, indexed by direction rank
+DIRECTION_STEPS = [0]*4
+DIRECTION_STEPS[RIGHT_RANK] = 1
+DIRECTION_STEPS[LEFT_RANK] = -1
+DIRECTION_STEPS[BOTTOM_RANK] = GRID_SIZE
+DIRECTION_STEPS[TOP_RANK] = -GRID_SIZE
+
+# directions indexed by rank
+DIRECTIONS = sorted(Wall, key=lambda direction: direction.rank())
+
+# the visited tables store for each state the depth modulo 16 on the 4 high
+# bits, and the last move (robot rank, direction rank) on the 4 low bits
+DEPTH_MODULO = 16
+MAX_STORED_DEPTH = DEPTH_MODULO - 1
+
 
 def move_v4(new_grid: List[List[List[int]]], src: Tuple[int, int], direction_value: int, state: Iterable[Tuple[int, int]]) -> Tuple[int, int]:
 
@@ -100,6 +123,135 @@ def move_v4(new_grid: List[List[List[int]]], src: Tuple[int, int], direction_val
         return i2, j
 
 
+def build_move_table(new_grid: List[List[List[int]]]) -> np.ndarray:
+    """
+    Precompute the destination of a lone robot for every move,
+    move_table[direction.rank()][i*16+j] is the case index reached from (i, j)
+    """
+    ranks = np.array(new_grid, dtype=np.int64)
+    rows, cols = np.indices((GRID_SIZE, GRID_SIZE))
+
+    move_table = np.empty((4, GRID_SIZE*GRID_SIZE), dtype=np.uint8)
+    for rank in (LEFT_RANK, RIGHT_RANK):
+        move_table[rank] = (rows*GRID_SIZE + ranks[rank]).ravel()
+    for rank in (TOP_RANK, BOTTOM_RANK):
+        move_table[rank] = (ranks[rank]*GRID_SIZE + cols).ravel()
+
+    return move_table
+
+
+def build_ray_masks(move_table: np.ndarray) -> List[List[int]]:
+    """
+    For every move of the move table, bitmask (1 << case) of the cases crossed
+    by the robot, start excluded and destination included
+    """
+    ray_masks = []
+    for rank, step in enumerate(DIRECTION_STEPS):
+        ray_masks.append([sum(1 << case for case in range(src + step, int(dst) + step, step))
+                          for src, dst in enumerate(move_table[rank])])
+    return ray_masks
+
+
+def occupancy_mask(cases: Iterable[int]) -> int:
+    occupancy = 0
+    for case in cases:
+        occupancy |= 1 << case
+    return occupancy
+
+
+def move_v5(move_table: List[List[int]], ray_masks: List[List[int]], src: int, direction_rank: int, occupancy: int) -> int:
+    """
+    Move a robot with the precomputed tables (see build_move_table), occupancy
+    is the bitmask of the robot cases (see occupancy_mask).
+    The robots on the way are found with a single bitwise and on the ray of the move.
+    """
+    blocking = occupancy & ray_masks[direction_rank][src]
+    if not blocking:
+        return move_table[direction_rank][src]
+
+    step = DIRECTION_STEPS[direction_rank]
+    if step < 0:
+        # closest robot has the highest case index
+        return blocking.bit_length() - 1 - step
+    return (blocking & -blocking).bit_length() - 1 - step
+
+
+def build_reverse_rays(move_table: np.ndarray, ray_masks: List[List[int]]) -> List[List[List[int]]]:
+    """
+    Reverse move table, reverse_rays[direction.rank()][case] lists the cases
+    (closest first) from which a lone robot moving in this direction goes through
+    or stops on the case
+    """
+    reverse_rays = []
+    for rank, step in enumerate(DIRECTION_STEPS):
+        rays = []
+        for case in range(len(move_table[rank])):
+            ray = []
+            src = case - step
+            while 0 <= src < len(move_table[rank]) and (ray_masks[rank][src] >> case) & 1:
+                ray.append(src)
+                src -= step
+            rays.append(ray)
+        reverse_rays.append(rays)
+    return reverse_rays
+
+
+def target_distances(move_table: List[List[int]], reverse_rays: List[List[List[int]]], dst: int, occupancy: int) -> bytearray:
+    """
+    Backward BFS from dst of a single robot, the other robots being fixed
+    obstacles (occupancy bitmask).
+    Returns the number of moves needed from every case, 255 if unreachable.
+    """
+    distances = bytearray(b"\xff"*len(move_table[0]))
+    if (occupancy >> dst) & 1:
+        return distances
+
+    distances[dst] = 0
+    to_see = [dst]
+    depth = 0
+    while to_see:
+        depth += 1
+        new_to_see = []
+        for case in to_see:
+            for rank, step in enumerate(DIRECTION_STEPS):
+                # the robot can only stop here if a wall or a robot is behind it
+                if move_table[rank][case] != case and not (occupancy >> (case + step)) & 1:
+                    continue
+                for src in reverse_rays[rank][case]:
+                    if (occupancy >> src) & 1:
+                        break
+                    if distances[src] == 255:
+                        distances[src] = depth
+                        new_to_see.append(src)
+        to_see = new_to_see
+
+    return distances
+
+
+def lower_bounds(reverse_rays: List[List[List[int]]], dst: int) -> bytearray:
+    """
+    Backward BFS from dst of a robot allowed to stop anywhere on its way.
+    Other robots can only make a robot stop before a wall, so the result is a
+    lower bound of the number of moves needed from every case (255 if unreachable).
+    """
+    distances = bytearray(b"\xff"*len(reverse_rays[0]))
+    distances[dst] = 0
+    to_see = [dst]
+    depth = 0
+    while to_see:
+        depth += 1
+        new_to_see = []
+        for case in to_see:
+            for rays in reverse_rays:
+                for src in rays[case]:
+                    if distances[src] == 255:
+                        distances[src] = depth
+                        new_to_see.append(src)
+        to_see = new_to_see
+
+    return distances
+
+
 def transform_state_v2(state: Dict[str, Tuple[int, int]]) -> Iterable[Tuple[int, int]]:
     new_state = [()]*len(state)
     for color, pos in state.items():
@@ -120,11 +272,15 @@ def explore_v2(new_grid: np.ndarray, initial_state: Iterable[Tuple[int, int]], d
 
     path = {hash(initial_state): (hash(initial_state), "", "")}
 
+    move_table = build_move_table(new_grid).tolist()
+    ray_masks = build_ray_masks(move_table)
+    directions = [(direction, direction.rank()) for direction in Wall]
+
     if initial_state[color_dst.value] == dst:
         return []
 
     for n in range(rec):
-        print(n, len(to_see))
+        count_level("explore_v2", n, len(to_see))
         new_to_see = []
 
         for state in to_see:
@@ -132,11 +288,13 @@ def explore_v2(new_grid: np.ndarray, initial_state: Iterable[Tuple[int, int]], d
             if hash_state not in seen:
                 seen.add(hash_state)
                 if n != rec - 1:
+                    cases = [int(i)*GRID_SIZE + int(j) for i, j in state]
+                    occupancy = occupancy_mask(cases)
                     for color in moving_colors:
                         color_rank = color.value
-                        for direction in Wall:
-                            new_pos = move_v4(
-                                new_grid, state[color_rank], direction.value, state)
+                        for direction, direction_rank in directions:
+                            new_pos = divmod(move_v5(
+                                move_table, ray_masks, cases[color_rank], direction_rank, occupancy), GRID_SIZE)
                             new_state = state[:color_rank] + \
                                 (new_pos,) + state[color_rank+1:]
                             hash_new_state = hash(new_state)
@@ -158,23 +316,468 @@ def explore_v2(new_grid: np.ndarray, initial_state: Iterable[Tuple[int, int]], d
         to_see = new_to_see
 
 
-def optimal_explore(new_grid, initial_state: Iterable[Tuple[int, int]], dst: Tuple[int, int], color_dst: Color):
+def pack_state(state: Iterable[Tuple[int, int]]) -> int:
+    """
+    Pack the robot positions (indexed by color value) in a single 32 bits integer,
+    the case i*16+j of robot k is stored in bits 8*k to 8*k+7
+    """
+    packed = 0
+    for rank, (i, j) in enumerate(state):
+        packed |= (int(i)*GRID_SIZE + int(j)) << (ROBOT_BITS*rank)
+    return packed
+
+
+def unpack_state(packed: int, nb_robots: int = len(Color)) -> Tuple[Tuple[int, int], ...]:
+    return tuple(divmod((packed >> (ROBOT_BITS*rank)) & ROBOT_MASK, GRID_SIZE)
+                 for rank in range(nb_robots))
+
+
+# budgets are checked every BUDGET_CHECK_PERIOD expanded states
+BUDGET_CHECK_PERIOD = 1024
+# approximate size of a packed state in a python list (pointer + int object)
+LIST_STATE_BYTES = 36
+
+
+class SearchBudget(NamedTuple):
+    max_seconds: Optional[float] = None
+    max_states: Optional[int] = None
+    max_memory: Optional[int] = None
+    cancel: Optional[threading.Event] = None  # set by another thread to stop the search
+
+    def exceeded(self, start_time: float, expanded: int, memory: int) -> Optional[str]:
+        """
+        Returns the name of the exceeded budget ("cancelled" if the cancel
+        event is set), None if the search can go on
+        """
+        if self.cancel is not None and self.cancel.is_set():
+            return "cancelled"
+        if self.max_seconds is not None and time.time() - start_time > self.max_seconds:
+            return "time"
+        if self.max_states is not None and expanded > self.max_states:
+            return "states"
+        if self.max_memory is not None and memory > self.max_memory:
+            return "memory"
+        return None
+
+
+class SearchResult(NamedTuple):
+    """
+    path is None if no solution was found, all the paths of at most depth
+    moves were explored, expanded is the number of expanded states and stop is
+    "solved", "exhausted" (rec reached) or the name of the exceeded budget
+    (see SearchBudget.exceeded)
+    """
+    path: Optional[List[Tuple[Color, Wall]]]
+    depth: int
+    expanded: int
+    stop: str
+
+    @property
+    def solved(self) -> bool:
+        return self.path is not None
+
+
+def encode_move(depth: int, rank: int, direction_rank: int) -> int:
+    return (depth % DEPTH_MODULO) << 4 | rank << 2 | direction_rank
+
+
+def canonical_state(state: int, free_shifts: List[int]) -> int:
+    """
+    Sort the cases of the interchangeable robots stored at the given bit shifts,
+    states that only differ by a permutation of these robots are the same
+    """
+    cases = sorted((state >> shift) & ROBOT_MASK for shift in free_shifts)
+    for shift, case in zip(free_shifts, cases):
+        state = (state & ~(ROBOT_MASK << shift)) | (case << shift)
+    return state
+
+
+def next_states(state: int, move_table: List[List[int]], ray_masks: List[List[int]], shifts: List[int],
+                moving_ranks: List[int], free_ranks: List[int] = (), free_shifts: List[int] = ()) -> List[Tuple[int, int, int, int]]:
+    """
+    States one move of a moving robot away from state: (new state, rank of the
+    moved robot in the new state, direction rank, new case of the moved robot).
+    With free_ranks (see canonical_state), the new states are canonical.
+    """
+    successors = []
+    cases = [(state >> shift) & ROBOT_MASK for shift in shifts]
+    occupancy = occupancy_mask(cases)
+    free_min, free_max = [-1]*len(shifts), [GRID_SIZE*GRID_SIZE]*len(shifts)
+    if free_ranks:
+        # the state stays canonical if the moved robot keeps its place in the order
+        free_cases = [-1] + [cases[rank]
+                             for rank in free_ranks] + [GRID_SIZE*GRID_SIZE]
+        for k, rank in enumerate(free_ranks):
+            free_min[rank], free_max[rank] = free_cases[k], free_cases[k+2]
+    for rank in moving_ranks:
+        case = cases[rank]
+        for direction_rank in range(len(DIRECTIONS)):
+            new_case = move_v5(
+                move_table, ray_masks, case, direction_rank, occupancy)
+            if new_case == case:
+                continue
+            new_state = state ^ ((case ^ new_case) << shifts[rank])
+            new_rank = rank
+            if not free_min[rank] < new_case < free_max[rank]:
+                new_state = canonical_state(new_state, free_shifts)
+                new_rank = next(r for r in free_ranks
+                                if (new_state >> shifts[r]) & ROBOT_MASK == new_case)
+            successors.append((new_state, new_rank, direction_rank, new_case))
+    return successors
+
+
+def rebuild_moves(visited: VisitedTable, initial: int, state: int, reverse_rays: List[List[List[int]]], nb_robots: int = len(Color), free_shifts: List[int] = ()) -> List[Tuple[int, int, int]]:
+    """
+    Rebuild the moves (start case, end case, direction rank) from initial to
+    state from a visited table filled with encode_move.
+    The parent of a state is the visited state of the previous depth found
+    on the reverse ray of its last move.
+    """
+    shifts = [ROBOT_BITS*rank for rank in range(nb_robots)]
+    moves = []
+    while state != initial:
+        value = visited.get(state)
+        depth, rank, direction_rank = value >> 4, (value >> 2) & 3, value & 3
+        cases = [(state >> shift) & ROBOT_MASK for shift in shifts]
+        case = cases[rank]
+        occupancy = occupancy_mask(cases) ^ (1 << case)
+        for src in reverse_rays[direction_rank][case]:
+            if (occupancy >> src) & 1:
+                break
+            parent = state ^ ((case ^ src) << shifts[rank])
+            if free_shifts:
+                parent = canonical_state(parent, free_shifts)
+            parent_value = visited.get(parent)
+            if parent_value is not None and parent_value >> 4 == (depth - 1) % DEPTH_MODULO:
+                break
+        else:
+            raise ValueError("No parent found in the visited table")
+        moves.append((src, case, direction_rank))
+        state = parent
+
+    return list(reversed(moves))
+
+
+def moves_to_path(initial: int, moves: Iterable[Tuple[int, int, int]], nb_robots: int = len(Color)) -> List[Tuple[Color, Wall]]:
+    """
+    Find the colors of the robots moved by rebuild_moves from their start cases
+    """
+    robots = {(initial >> (ROBOT_BITS*rank)) & ROBOT_MASK: rank
+              for rank in range(nb_robots)}
+    path = []
+    for src, dst, direction_rank in moves:
+        rank = robots.pop(src)
+        robots[dst] = rank
+        path.append((revert_color_value(rank), DIRECTIONS[direction_rank]))
+    return path
+
+
+def explore_v3(new_grid: List[List[List[int]]], initial_state: Iterable[Tuple[int, int]], dst: Tuple[int, int], color_dst: Color, moving_colors=None, rec=13, canonical=False, budget=None):
+    """
+    Same BFS as explore_v2 (same arguments and output) but the states are
+    packed in integers (see pack_state), so that no tuple is allocated
+    and no hash is computed in the inner loop.
+    See search_v3 for the other arguments.
+    """
+    return search_v3(new_grid, initial_state, dst, color_dst, moving_colors, rec, canonical, budget).path
+
+
+def search_v3(new_grid: List[List[List[int]]], initial_state: Iterable[Tuple[int, int]], dst: Tuple[int, int], color_dst: Color, moving_colors=None, rec=13, canonical=False, budget: Optional[SearchBudget] = None) -> SearchResult:
+    """
+    BFS of explore_v3, returns a SearchResult.
+    The visited states are kept in a VisitedTable (see encode_move), so rec
+    is limited to MAX_STORED_DEPTH + 1.
+    With canonical=True, the moving robots other than the target one are
+    considered interchangeable (see canonical_state), up to 6 times less states.
+    The search stops early when the budget is exceeded.
+    """
+    if rec > MAX_STORED_DEPTH + 1:
+        raise ValueError(f"rec must be at most {MAX_STORED_DEPTH + 1}")
+
+    if moving_colors is None:
+        moving_colors = list(Color)
+
+    nb_robots = len(initial_state)
+    shifts = [ROBOT_BITS*rank for rank in range(nb_robots)]
+    dst_case = int(dst[0])*GRID_SIZE + int(dst[1])
+    dst_rank = color_dst.value
+    moving_ranks = [color.value for color in moving_colors]
+    free_ranks = [rank for rank in moving_ranks if rank != dst_rank]
+    if not canonical or len(free_ranks) < 2:
+        free_ranks = []
+    free_shifts = [shifts[rank] for rank in free_ranks]
+    move_table = build_move_table(new_grid).tolist()
+    ray_masks = build_ray_masks(move_table)
+
+    initial = pack_state(initial_state)
+    if (initial >> shifts[dst_rank]) & ROBOT_MASK == dst_case:
+        return SearchResult([], 0, 0, "solved")
+
+    start_time = time.time()
+    expanded = 0
+
+    start = canonical_state(initial, free_shifts)
+    visited = VisitedTable()
+    visited.add(start, encode_move(0, 0, 0))
+    to_see = [start]
+
+    for depth in range(1, rec):
+        count_level("search_v3", depth - 1, len(to_see))
+        new_to_see = []
+
+        for state in to_see:
+            expanded += 1
+            if budget is not None and not expanded % BUDGET_CHECK_PERIOD:
+                memory = visited.nbytes + LIST_STATE_BYTES * \
+                    (len(to_see) + len(new_to_see))
+                stop = budget.exceeded(start_time, expanded, memory)
+                if stop is not None:
+                    return SearchResult(None, depth - 1, expanded, stop)
+
+            for new_state, new_rank, direction_rank, new_case in next_states(
+                    state, move_table, ray_masks, shifts, moving_ranks, free_ranks, free_shifts):
+                if not visited.add(new_state, encode_move(depth, new_rank, direction_rank)):
+                    continue
+                new_to_see.append(new_state)
+
+                if new_rank == dst_rank and new_case == dst_case:
+                    reverse_rays = build_reverse_rays(
+                        move_table, ray_masks)
+                    moves = rebuild_moves(visited, start, new_state, reverse_rays,
+                                          nb_robots, free_shifts)
+                    return SearchResult(moves_to_path(initial, moves, nb_robots), depth, expanded, "solved")
+
+        to_see = new_to_see
+
+    return SearchResult(None, rec - 1, expanded, "exhausted")
+
+
+def explore_bidirectional(new_grid: List[List[List[int]]], initial_state: Iterable[Tuple[int, int]], dst: Tuple[int, int], color_dst: Color, moving_colors=None, rec=13, canonical=False):
+    """
+    Meet in the middle version of explore_v3 (same arguments and output).
+
+    The forward BFS on all the robots meets a backward BFS from dst of the
+    target robot alone (see target_distances), done once for each placement of
+    the other robots. As the last moves of a solution after the last move of
+    another robot only move the target robot, the optimal path is found when the
+    forward BFS reaches 2 moves less than the solution length.
+    canonical is the same option as in explore_v3.
+    """
+    if rec > MAX_STORED_DEPTH + 2:
+        raise ValueError(f"rec must be at most {MAX_STORED_DEPTH + 2}")
+
+    if moving_colors is None:
+        moving_colors = list(Color)
+
+    nb_robots = len(initial_state)
+    shifts = [ROBOT_BITS*rank for rank in range(nb_robots)]
+    dst_case = int(dst[0])*GRID_SIZE + int(dst[1])
+    dst_rank = color_dst.value
+    dst_shift = shifts[dst_rank]
+    others_mask = ~(ROBOT_MASK << dst_shift)
+    moving_ranks = [color.value for color in moving_colors]
+    free_ranks = [rank for rank in moving_ranks if rank != dst_rank]
+    if not canonical or len(free_ranks) < 2:
+        free_ranks = []
+    free_shifts = [shifts[rank] for rank in free_ranks]
+    move_table = build_move_table(new_grid).tolist()
+    ray_masks = build_ray_masks(move_table)
+    reverse_rays = build_reverse_rays(move_table, ray_masks)
+
+    initial = pack_state(initial_state)
+    if (initial >> dst_shift) & ROBOT_MASK == dst_case:
+        return []
+
+    # the distances of the target robot are only computed for the states whose
+    # lower bound may improve the best length, and kept for one level so the
+    # tables in memory are bounded by the frontier (a fixed target never arrives)
+    if dst_rank in moving_ranks:
+        bounds = lower_bounds(reverse_rays, dst_case)
+    else:
+        bounds = bytearray(b"\xff"*len(move_table[0]))
+    level_distances = {}
+
+    def get_distances(state):
+        others = state & others_mask
+        if others not in level_distances:
+            occupancy = occupancy_mask((state >> shift) & ROBOT_MASK
+                                       for rank, shift in enumerate(shifts) if rank != dst_rank)
+            level_distances[others] = target_distances(
+                move_table, reverse_rays, dst_case, occupancy)
+        return level_distances[others]
+
+    start = canonical_state(initial, free_shifts)
+    visited = VisitedTable()
+    visited.add(start, encode_move(0, 0, 0))
+    to_see = [start]
+    best_length, best_state, best_distances = rec, None, None
+
+    for depth in range(rec):
+        level_distances.clear()
+        for state in to_see:
+            case = (state >> dst_shift) & ROBOT_MASK
+            if depth + bounds[case] >= best_length:
+                continue
+            distances = get_distances(state)
+            if depth + distances[case] < best_length:
+                best_length, best_state, best_distances = depth + distances[case], state, distances
+
+        # unseen solutions need at least 2 more moves than the current depth
+        if best_length <= depth + 2 or depth + 3 > rec:
+            break
+
+        new_to_see = []
+        for state in to_see:
+            for new_state, new_rank, direction_rank, _ in next_states(
+                    state, move_table, ray_masks, shifts, moving_ranks, free_ranks, free_shifts):
+                if visited.add(new_state, encode_move(depth + 1, new_rank, direction_rank)):
+                    new_to_see.append(new_state)
+        to_see = new_to_see
+
+    if best_state is None:
+        return None
+
+    moves = rebuild_moves(visited, start, best_state,
+                          reverse_rays, nb_robots, free_shifts)
+
+    # finish with the target robot alone, following the decreasing distances
+    state, distances = best_state, best_distances
+    occupancy = occupancy_mask((state >> shift) & ROBOT_MASK for shift in shifts)
+    case = (state >> dst_shift) & ROBOT_MASK
+    while case != dst_case:
+        for direction_rank in range(len(DIRECTIONS)):
+            new_case = move_v5(move_table, ray_masks,
+                               case, direction_rank, occupancy)
+            if distances[new_case] == distances[case] - 1:
+                break
+        moves.append((case, new_case, direction_rank))
+        occupancy ^= (1 << case) | (1 << new_case)
+        case = new_case
+
+    return moves_to_path(initial, moves, nb_robots)
+
+
+def ida_star(new_grid: List[List[List[int]]], initial_state: Iterable[Tuple[int, int]], dst: Tuple[int, int], color_dst: Color, moving_colors=None, rec=13):
+    """
+    Iterative deepening A* (same arguments and output as explore_v3).
+    Depth first searches with increasing maximum length, the branches are cut
+    with the lower bounds of the target robot (see lower_bounds), so the memory
+    only depends on the depth.
+    """
+    if moving_colors is None:
+        moving_colors = list(Color)
+
+    nb_robots = len(initial_state)
+    shifts = [ROBOT_BITS*rank for rank in range(nb_robots)]
+    dst_case = int(dst[0])*GRID_SIZE + int(dst[1])
+    dst_rank = color_dst.value
+    moving_ranks = [color.value for color in moving_colors]
+    directions = [(direction, direction.rank()) for direction in Wall]
+    move_table = build_move_table(new_grid).tolist()
+    ray_masks = build_ray_masks(move_table)
+    bounds = lower_bounds(build_reverse_rays(move_table, ray_masks), dst_case)
+
+    initial = pack_state(initial_state)
+    initial_bound = bounds[(initial >> shifts[dst_rank]) & ROBOT_MASK]
+    if initial_bound == 0:
+        return []
+
+    path = []
+
+    def search(state, depth, max_length):
+        cases = [(state >> shift) & ROBOT_MASK for shift in shifts]
+        occupancy = occupancy_mask(cases)
+        for rank in moving_ranks:
+            case = cases[rank]
+            for direction, direction_rank in directions:
+                new_case = move_v5(
+                    move_table, ray_masks, case, direction_rank, occupancy)
+                if new_case == case:
+                    continue
+                bound = bounds[new_case if rank ==
+                               dst_rank else cases[dst_rank]]
+                if bound == 0:
+                    path.append((rank, direction))
+                    return True
+                if depth + 1 + bound > max_length:
+                    continue
+                path.append((rank, direction))
+                if search(state ^ ((case ^ new_case) << shifts[rank]), depth + 1, max_length):
+                    return True
+                path.pop()
+        return False
+
+    for max_length in range(initial_bound, rec):
+        if search(initial, 0, max_length):
+            return [(revert_color_value(rank), direction) for rank, direction in path]
+
+    return None
+
+
+def optimal_explore(new_grid, initial_state: Iterable[Tuple[int, int]], dst: Tuple[int, int], color_dst: Color,
+                    rec_depths=(MAX_STORED_DEPTH + 1, MAX_STORED_DEPTH + 1, 13, 11), max_seconds=None, search=search_v3):
+    """
+    Staged search of optimal_search with a time budget, returns the best path found
+    """
+    return optimal_search(new_grid, initial_state, dst, color_dst, rec_depths,
+                          SearchBudget(max_seconds=max_seconds), search).path
+
+
+def optimal_search(new_grid, initial_state: Iterable[Tuple[int, int]], dst: Tuple[int, int], color_dst: Color,
+                   rec_depths=(MAX_STORED_DEPTH + 1, MAX_STORED_DEPTH + 1, 13, 11), budget: Optional[SearchBudget] = None,
+                   search=search_v3) -> SearchResult:
+    """
+    Staged search: the target robot alone first, then with one helper robot,
+    then with two, etc. rec_depths[k] is the rec of the stages with k helpers.
+    Each search only looks for paths shorter than the best one found so far,
+    and the search stops as soon as the lower bound of the target robot is
+    reached (see lower_bounds).
+    The budget is shared by all the searches (search is a function with the
+    arguments of search_v3), when it is exceeded the best path found so far
+    is returned. depth is the one of the last search.
+    """
+    start_time = time.time()
+    if budget is None:
+        budget = SearchBudget()
+
+    dst_case = int(dst[0])*GRID_SIZE + int(dst[1])
+    move_table = build_move_table(new_grid).tolist()
+    bounds = lower_bounds(build_reverse_rays(
+        move_table, build_ray_masks(move_table)), dst_case)
+    i, j = initial_state[color_dst.value]
+    min_length = bounds[int(i)*GRID_SIZE + int(j)]
+    if min_length == 255:
+        return SearchResult(None, MAX_STORED_DEPTH, 0, "exhausted")
 
     other_colors = [c for c in Color if c is not color_dst]
 
     best_path = None
     best_path_length = 100
+    result = SearchResult(None, 0, 0, "exhausted")
+    expanded = 0
 
-    rec_depths = [100, 20, 13, 10, 7, 3][:len(other_colors)]
-
-    for nb_other_bot_moving, rec_depth in enumerate(rec_depth):
+    for nb_other_bot_moving, rec_depth in enumerate(rec_depths[:len(other_colors) + 1]):
         for colors_sample in combinations(other_colors, nb_other_bot_moving):
 
-            p0 = explore_v2(new_grid, initial_state, dst, color_dst,
-                            moving_colors=colors_sample,
-                            rec=min(best_path_length, rec_depth))
-            if p0 is not None and len(p0) < best_path_length:
-                best_path_length = len(p0)
-                best_path = p0
-
-    return best_path
+            if best_path_length <= min_length:
+                return SearchResult(best_path, result.depth, expanded, "solved")
+
+            stop = budget.exceeded(start_time, expanded, 0)
+            if stop is not None:
+                return SearchResult(best_path, result.depth, expanded, stop)
+
+            remaining = budget._replace(
+                max_seconds=None if budget.max_seconds is None else budget.max_seconds -
+                (time.time() - start_time),
+                max_states=None if budget.max_states is None else budget.max_states - expanded)
+            result = search(new_grid, initial_state, dst, color_dst,
+                            moving_colors=[color_dst, *colors_sample],
+                            rec=min(best_path_length, rec_depth), budget=remaining)
+            expanded += result.expanded
+            if result.path is not None and len(result.path) < best_path_length:
+                best_path_length = len(result.path)
+                best_path = result.path
+            if result.stop not in ("solved", "exhausted"):
+                return SearchResult(best_path, result.depth, expanded, result.stop)
+
+    return SearchResult(best_path, result.depth, expanded, "solved" if best_path is not None else "exhausted")
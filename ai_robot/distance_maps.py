@@ -0,0 +1,89 @@
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+from ai_robot.ai_robot import (DIRECTION_STEPS, GRID_SIZE, build_move_table,
+                               build_ray_masks, move_v5, occupancy_mask)
+
+# distance between two cases not connected
+UNREACHABLE = 255
+
+NB_CASES = GRID_SIZE*GRID_SIZE
+
+
+def all_pairs_distances(adjacency: np.ndarray) -> np.ndarray:
+    """
+    Number of moves between all the pairs of cases, adjacency[src, dst] is True
+    when a single move goes from src to dst. One BFS from every case at once,
+    each level is a product of the frontier with the adjacency matrix.
+    """
+    distances = np.full(adjacency.shape, UNREACHABLE, dtype=np.uint8)
+    np.fill_diagonal(distances, 0)
+    reached = np.eye(len(adjacency), dtype=bool)
+    frontier = reached
+    adjacency = adjacency.astype(np.float32)
+
+    depth = 0
+    while frontier.any():
+        depth += 1
+        frontier = (frontier.astype(np.float32) @ adjacency > 0) & ~reached
+        distances[frontier] = depth
+        reached |= frontier
+
+    return distances
+
+
+def moves_adjacency(move_table: List[List[int]]) -> np.ndarray:
+    adjacency = np.zeros((NB_CASES, NB_CASES), dtype=bool)
+    for destinations in move_table:
+        adjacency[np.arange(NB_CASES), destinations] = True
+    return adjacency
+
+
+def lone_robot_distances(new_grid: List[List[List[int]]]) -> np.ndarray:
+    """
+    distances[src, dst], number of moves of a robot alone on the board
+    """
+    return all_pairs_distances(moves_adjacency(build_move_table(new_grid)))
+
+
+def obstacle_distances(new_grid: List[List[List[int]]], obstacles: Iterable[int]) -> np.ndarray:
+    """
+    Same as lone_robot_distances, with fixed robots on the obstacles cases.
+    As the other robots can stay still, it is an upper bound of the number
+    of moves needed with all the robots.
+    """
+    move_table = build_move_table(new_grid).tolist()
+    ray_masks = build_ray_masks(move_table)
+    obstacles = list(obstacles)
+    occupancy = occupancy_mask(obstacles)
+
+    table = [[move_v5(move_table, ray_masks, case, rank, occupancy)
+              for case in range(NB_CASES)] for rank in range(len(move_table))]
+    adjacency = moves_adjacency(table)
+    adjacency[obstacles] = False
+    return all_pairs_distances(adjacency)
+
+
+def robot_distances(new_grid: List[List[List[int]]], initial_state: Iterable[Tuple[int, int]]) -> np.ndarray:
+    """
+    obstacle_distances of each robot, the other robots being the obstacles,
+    distances[rank, src, dst]
+    """
+    cases = [int(i)*GRID_SIZE + int(j) for i, j in initial_state]
+    return np.stack([obstacle_distances(new_grid, cases[:rank] + cases[rank + 1:])
+                     for rank in range(len(cases))])
+
+
+def relaxed_distances(new_grid: List[List[List[int]]]) -> np.ndarray:
+    """
+    distances[src, dst] of a robot allowed to stop anywhere on its way
+    (all-pairs version of lower_bounds), a lower bound of the number of moves
+    needed whatever the other robots do
+    """
+    move_table = build_move_table(new_grid).tolist()
+    adjacency = np.zeros((NB_CASES, NB_CASES), dtype=bool)
+    for rank, step in enumerate(DIRECTION_STEPS):
+        for case in range(NB_CASES):
+            adjacency[case, range(case + step, move_table[rank][case] + step, step)] = True
+    return all_pairs_distances(adjacency)
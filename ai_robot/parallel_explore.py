@@ -0,0 +1,163 @@
+from multiprocessing import Pool, cpu_count
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from ai_robot.ai_robot import (DIRECTIONS, GRID_SIZE, MAX_STORED_DEPTH,
+                               ROBOT_BITS, ROBOT_MASK, build_move_table,
+                               build_ray_masks, build_reverse_rays,
+                               encode_move, move_v5, moves_to_path,
+                               occupancy_mask, pack_state, rebuild_moves)
+from image_extraction.Color import Color
+from tools.VisitedTable import VisitedTable
+
+# below this number of states, a level is expanded by the main process
+MIN_PARALLEL_STATES = 5000
+
+# tables of the worker processes, set by init_worker
+WORKER: Dict[str, list] = {}
+
+
+def init_worker(move_table: List[List[int]], ray_masks: List[List[int]], shifts: List[int], moving_ranks: List[int]):
+    WORKER["move_table"] = move_table
+    WORKER["ray_masks"] = ray_masks
+    WORKER["shifts"] = shifts
+    WORKER["moving_ranks"] = moving_ranks
+
+
+def expand_states(task: Tuple[str, int, int, str, int, int]) -> Tuple[np.ndarray, bytes]:
+    """
+    Expand the states start:stop of the shared frontier, and return the new
+    states (not in the shared visited table) with their encoded moves,
+    in the order of the serial BFS
+    """
+    frontier_name, start, stop, visited_name, visited_capacity, depth = task
+    move_table, ray_masks = WORKER["move_table"], WORKER["ray_masks"]
+    shifts, moving_ranks = WORKER["shifts"], WORKER["moving_ranks"]
+
+    frontier_shm = SharedMemory(name=frontier_name)
+    frontier = np.ndarray((stop,), dtype=np.uint32, buffer=frontier_shm.buf)
+    states = frontier[start:stop].tolist()
+    del frontier
+    frontier_shm.close()
+
+    visited = VisitedTable.attach(visited_name, visited_capacity)
+    new_states = []
+    moves = bytearray()
+    seen = set()
+
+    for state in states:
+        cases = [(state >> shift) & ROBOT_MASK for shift in shifts]
+        occupancy = occupancy_mask(cases)
+        for rank in moving_ranks:
+            case = cases[rank]
+            for direction_rank in range(len(DIRECTIONS)):
+                new_case = move_v5(move_table, ray_masks,
+                                   case, direction_rank, occupancy)
+                if new_case == case:
+                    continue
+                new_state = state ^ ((case ^ new_case) << shifts[rank])
+                if new_state in seen or new_state in visited:
+                    continue
+                seen.add(new_state)
+                new_states.append(new_state)
+                moves.append(encode_move(depth, rank, direction_rank))
+
+    visited.close(unlink=False)
+    return np.array(new_states, dtype=np.uint32), bytes(moves)
+
+
+def explore_parallel(new_grid: List[List[List[int]]], initial_state: Iterable[Tuple[int, int]], dst: Tuple[int, int], color_dst: Color, moving_colors=None, rec=13, processes=None):
+    """
+    Parallel version of explore_v3 (same arguments and output, same path).
+    Each level of the BFS is split in chunks expanded by a pool of processes,
+    which read the frontier and the visited states from shared memory and
+    drop the states already visited. The main process merges the chunks in
+    order in the visited table, so the result is the one of the serial BFS.
+    The levels smaller than MIN_PARALLEL_STATES, and all of them with one
+    process, are expanded by the main process without starting the pool.
+    """
+    if rec > MAX_STORED_DEPTH + 1:
+        raise ValueError(f"rec must be at most {MAX_STORED_DEPTH + 1}")
+
+    if moving_colors is None:
+        moving_colors = list(Color)
+    if processes is None:
+        processes = cpu_count()
+
+    nb_robots = len(initial_state)
+    shifts = [ROBOT_BITS*rank for rank in range(nb_robots)]
+    dst_case = int(dst[0])*GRID_SIZE + int(dst[1])
+    dst_shift = shifts[color_dst.value]
+    moving_ranks = [color.value for color in moving_colors]
+    move_table = build_move_table(new_grid).tolist()
+    ray_masks = build_ray_masks(move_table)
+    worker_args = (move_table, ray_masks, shifts, moving_ranks)
+
+    initial = pack_state(initial_state)
+    if (initial >> dst_shift) & ROBOT_MASK == dst_case:
+        return []
+
+    # the main process also expands the small levels itself, the pool is only
+    # started for the first level large enough to be split
+    init_worker(*worker_args)
+    pool = None
+
+    visited = VisitedTable(shared=True)
+    visited.add(initial, encode_move(0, 0, 0))
+    to_see = np.array([initial], dtype=np.uint32)
+
+    try:
+        for depth in range(1, rec):
+            if not len(to_see):
+                break
+
+            frontier_shm = SharedMemory(create=True, size=4*len(to_see))
+            frontier = np.ndarray((len(to_see),), dtype=np.uint32,
+                                  buffer=frontier_shm.buf)
+            frontier[:] = to_see
+            del frontier
+
+            nb_chunks = 1 if len(
+                to_see) < MIN_PARALLEL_STATES or processes < 2 else 4*processes
+            bounds = np.linspace(0, len(to_see), nb_chunks + 1).astype(int)
+            tasks = [(frontier_shm.name, start, stop, visited.shm.name, visited.capacity, depth)
+                     for start, stop in zip(bounds[:-1], bounds[1:])]
+            if nb_chunks == 1:
+                results = [expand_states(tasks[0])]
+            else:
+                if pool is None:
+                    pool = Pool(processes, initializer=init_worker,
+                                initargs=worker_args)
+                results = pool.map(expand_states, tasks)
+
+            frontier_shm.close()
+            frontier_shm.unlink()
+
+            # the chunks only hold unvisited states, the states found by
+            # several chunks are kept at their first position, as in the serial BFS
+            new_states = np.concatenate([states for states, _ in results])
+            new_moves = np.frombuffer(
+                b"".join(moves for _, moves in results), dtype=np.uint8)
+            first = np.sort(np.unique(new_states, return_index=True)[1])
+            new_states, new_moves = new_states[first], new_moves[first]
+
+            solved = np.flatnonzero(
+                ((new_states >> dst_shift) & ROBOT_MASK) == dst_case)
+            if solved.size:
+                new_states = new_states[:solved[0] + 1]
+            for new_state, move in zip(new_states.tolist(), new_moves.tolist()):
+                visited.add(new_state, move)
+
+            if solved.size:
+                reverse_rays = build_reverse_rays(move_table, ray_masks)
+                moves = rebuild_moves(visited, initial, int(new_states[-1]),
+                                      reverse_rays, nb_robots)
+                return moves_to_path(initial, moves, nb_robots)
+
+            to_see = new_states
+    finally:
+        if pool is not None:
+            pool.terminate()
+        visited.close()
@@ -0,0 +1,98 @@
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from typing import Any, Iterable, Optional, Tuple
+
+import numpy as np
+
+from image_extraction.Color import Color
+
+
+def board_key(new_grid: np.ndarray, initial_state: Iterable[Tuple[int, int]]) -> str:
+    """
+    Digest of a board: the walls (transform_grid output) and the robots positions
+    """
+    digest = hashlib.sha1(np.ascontiguousarray(new_grid, dtype=np.uint8).tobytes())
+    digest.update(bytes(int(x) for pos in initial_state for x in pos))
+    return digest.hexdigest()
+
+
+def query_key(new_grid: np.ndarray, initial_state: Iterable[Tuple[int, int]], dst: Tuple[int, int], color_dst: Color) -> str:
+    """
+    Digest of a query: the board plus the robot to move and its target
+    """
+    return f"{board_key(new_grid, initial_state)}-{color_dst.value}-{int(dst[0])}-{int(dst[1])}"
+
+
+def image_key(img) -> str:
+    """
+    Digest of the pixels of an input image (PIL image or array)
+    """
+    return hashlib.sha1(np.ascontiguousarray(img).tobytes()).hexdigest()
+
+
+class SolveCache:
+    """
+    LRU cache of the last maxsize values, optionally backed by a directory
+    with one pickle file per key, so that the results survive restarts
+    and are shared by the processes of the server. Thread safe.
+    """
+
+    def __init__(self, maxsize: int = 256, directory: Optional[str] = None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.pickle")
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        if self.directory is not None and os.path.isfile(self._path(key)):
+            try:
+                with open(self._path(key), "rb") as file:
+                    value = pickle.load(file)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                return default
+            self._store(key, value)
+            return value
+
+        return default
+
+    def put(self, key: str, value: Any, persist: bool = True):
+        """
+        Add the value to the cache, and to the directory if persist is True
+        """
+        self._store(key, value)
+        if persist and self.directory is not None:
+            # write then rename, readers never see a partial file
+            tmp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as file:
+                pickle.dump(value, file)
+            os.replace(tmp_path, self._path(key))
+
+    def _store(self, key: str, value: Any):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries or (self.directory is not None and os.path.isfile(self._path(key)))
+
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -0,0 +1,292 @@
+import time
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from ai_robot.ai_robot import (DIRECTION_STEPS, DIRECTIONS, GRID_SIZE,
+                               MAX_STORED_DEPTH, ROBOT_BITS, ROBOT_MASK,
+                               SearchBudget, SearchResult, build_move_table,
+                               build_ray_masks, build_reverse_rays,
+                               encode_move, moves_to_path, pack_state,
+                               rebuild_moves)
+from image_extraction.Color import Color
+from image_extraction.Wall import Wall
+from tools.instrumentation import count_level
+
+# approximate peak memory used by each successor while expanding a level
+# (state, move, np.unique sort and index arrays)
+SUCCESSOR_BYTES = 32
+
+# depth of the cases not reached by explore_all_targets
+UNREACHED = 255
+
+
+class SortedLevels:
+    """
+    Visited states of the vectorized BFS: for each depth, a sorted array of
+    the states and the array of their encoded moves (see encode_move).
+    Same get method as VisitedTable, to rebuild the paths with rebuild_moves.
+    """
+
+    def __init__(self):
+        self.states = []
+        self.moves = []
+
+    def append(self, states: np.ndarray, moves: np.ndarray):
+        self.states.append(states)
+        self.moves.append(moves)
+
+    def contains(self, states: np.ndarray) -> np.ndarray:
+        found = np.zeros(len(states), dtype=bool)
+        for level in self.states:
+            if len(level):
+                index = np.searchsorted(level, states).clip(max=len(level) - 1)
+                found |= level[index] == states
+        return found
+
+    def get(self, state: int, default: Optional[int] = None) -> Optional[int]:
+        for level, moves in zip(self.states, self.moves):
+            index = np.searchsorted(level, state)
+            if index < len(level) and level[index] == state:
+                return int(moves[index])
+        return default
+
+    def add_level(self, new_states: List[np.ndarray], new_moves: List[np.ndarray]) -> np.ndarray:
+        """
+        Append the states not already visited among the successors new_states
+        (with their moves, the first move is kept for duplicates), returns them
+        """
+        new_states, first = np.unique(np.concatenate(new_states),
+                                      return_index=True)
+        new_moves = np.concatenate(new_moves)[first]
+        unseen = ~self.contains(new_states)
+        self.append(new_states[unseen], new_moves[unseen])
+        return self.states[-1]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(level.nbytes + moves.nbytes for level, moves in zip(self.states, self.moves))
+
+
+def move_all(move_table: np.ndarray, rows: List[np.ndarray], cols: List[np.ndarray], rank: int, direction_rank: int) -> np.ndarray:
+    """
+    Vectorized move_v5, moves the robot rank of every state of the level,
+    rows and cols are the coordinates of each robot in each state
+    """
+    step = DIRECTION_STEPS[direction_rank]
+    horizontal = abs(step) == 1
+    lines, positions = (rows, cols) if horizontal else (cols, rows)
+
+    dst = move_table[direction_rank][rows[rank]*GRID_SIZE + cols[rank]]
+    dst = (dst % GRID_SIZE if horizontal else dst // GRID_SIZE).astype(np.int32)
+
+    line, position = lines[rank], positions[rank]
+    for other in range(len(rows)):
+        if other == rank:
+            continue
+        other_position = positions[other]
+        same_line = lines[other] == line
+        if step < 0:
+            blocking = same_line & (dst <= other_position) & (
+                other_position < position)
+            dst = np.where(blocking, other_position + 1, dst)
+        else:
+            blocking = same_line & (position < other_position) & (
+                other_position <= dst)
+            dst = np.where(blocking, other_position - 1, dst)
+
+    if horizontal:
+        return line*GRID_SIZE + dst
+    return dst*GRID_SIZE + line
+
+
+def successors(move_table: np.ndarray, to_see: np.ndarray, shifts: List[int], moving_ranks: List[int], depth: int) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Successors of the packed states to_see, yields for each moving robot and
+    direction the new states and their encoded moves (see encode_move)
+    """
+    cases = [((to_see >> shift) & ROBOT_MASK).astype(np.int32)
+             for shift in shifts]
+    rows = [case // GRID_SIZE for case in cases]
+    cols = [case % GRID_SIZE for case in cases]
+
+    for rank in moving_ranks:
+        for direction_rank in range(len(DIRECTIONS)):
+            new_case = move_all(move_table, rows, cols, rank, direction_rank)
+            moved = new_case != cases[rank]
+            delta = (cases[rank][moved] ^ new_case[moved]).astype(np.uint32)
+            yield (to_see[moved] ^ (delta << shifts[rank]),
+                   np.full(len(delta), encode_move(depth, rank, direction_rank), dtype=np.uint8))
+
+
+def explore_vectorized(new_grid: List[List[List[int]]], initial_state: Iterable[Tuple[int, int]], dst: Tuple[int, int], color_dst: Color, moving_colors=None, rec=13, budget=None):
+    """
+    Vectorized version of explore_v3 (same arguments and output, a path of the
+    same length), see search_vectorized
+    """
+    return search_vectorized(new_grid, initial_state, dst, color_dst, moving_colors, rec, budget).path
+
+
+def search_vectorized(new_grid: List[List[List[int]]], initial_state: Iterable[Tuple[int, int]], dst: Tuple[int, int], color_dst: Color, moving_colors=None, rec=13, budget: Optional[SearchBudget] = None) -> SearchResult:
+    """
+    Vectorized version of search_v3. Each level of the BFS is a NumPy array of
+    packed states, the successors of the whole level are computed at once with
+    the move table, and the duplicates removed with np.unique and binary
+    searches in the sorted previous levels.
+    The states and memory budgets are checked before expanding a level, from
+    the size of the level, so that the search stops before running out of memory.
+    """
+    if rec > MAX_STORED_DEPTH + 1:
+        raise ValueError(f"rec must be at most {MAX_STORED_DEPTH + 1}")
+
+    if moving_colors is None:
+        moving_colors = list(Color)
+
+    nb_robots = len(initial_state)
+    shifts = [ROBOT_BITS*rank for rank in range(nb_robots)]
+    dst_case = int(dst[0])*GRID_SIZE + int(dst[1])
+    dst_shift = shifts[color_dst.value]
+    moving_ranks = [color.value for color in moving_colors]
+    move_table = build_move_table(new_grid)
+
+    initial = pack_state(initial_state)
+    if (initial >> dst_shift) & ROBOT_MASK == dst_case:
+        return SearchResult([], 0, 0, "solved")
+
+    if budget is None:
+        budget = SearchBudget()
+    start_time = time.time()
+    expanded = 0
+
+    levels = SortedLevels()
+    to_see = np.array([initial], dtype=np.uint32)
+    levels.append(to_see, np.array([encode_move(0, 0, 0)], dtype=np.uint8))
+
+    for depth in range(1, rec):
+        if not len(to_see):
+            break
+
+        count_level("search_vectorized", depth - 1, len(to_see))
+        nb_successors = len(to_see)*len(moving_ranks)*len(DIRECTIONS)
+        stop = budget.exceeded(start_time, expanded + len(to_see),
+                               levels.nbytes + SUCCESSOR_BYTES*nb_successors)
+        if stop is not None:
+            return SearchResult(None, depth - 1, expanded, stop)
+        expanded += len(to_see)
+
+        new_states, new_moves = [], []
+        for states, moves in successors(move_table, to_see, shifts, moving_ranks, depth):
+            new_states.append(states)
+            new_moves.append(moves)
+            stop = budget.exceeded(start_time, 0, 0)
+            if stop is not None:
+                return SearchResult(None, depth - 1, expanded, stop)
+        to_see = levels.add_level(new_states, new_moves)
+
+        solved = np.flatnonzero(
+            (to_see >> dst_shift) & ROBOT_MASK == dst_case)
+        if len(solved):
+            reverse_rays = build_reverse_rays(
+                move_table, build_ray_masks(move_table))
+            moves = rebuild_moves(levels, initial, int(to_see[solved[0]]),
+                                  reverse_rays, nb_robots)
+            return SearchResult(moves_to_path(initial, moves, nb_robots), depth, expanded, "solved")
+
+    return SearchResult(None, rec - 1, expanded, "exhausted")
+
+
+class AllTargets(NamedTuple):
+    depths: np.ndarray  # (nb_robots, 16, 16) optimal number of moves, UNREACHED if more than depth
+    states: np.ndarray  # (nb_robots, 16, 16) a packed state of the BFS reaching the case at this depth
+    depth: int  # all the paths of at most depth moves were explored
+    stop: str  # "exhausted" or the name of the exceeded budget
+    initial: int
+    levels: SortedLevels
+    reverse_rays: List[List[List[int]]]
+
+
+def explore_all_targets(new_grid: List[List[List[int]]], initial_state: Iterable[Tuple[int, int]], moving_colors=None, rec=11, budget: Optional[SearchBudget] = None) -> AllTargets:
+    """
+    Single BFS from the initial state (same levels as search_vectorized, up to
+    rec-1 moves), recording for every robot and case the first depth at which
+    the robot reaches it. Answers all the queries of a board, see target_path.
+    """
+    if rec > MAX_STORED_DEPTH + 1:
+        raise ValueError(f"rec must be at most {MAX_STORED_DEPTH + 1}")
+
+    if moving_colors is None:
+        moving_colors = list(Color)
+
+    nb_robots = len(initial_state)
+    shifts = [ROBOT_BITS*rank for rank in range(nb_robots)]
+    moving_ranks = [color.value for color in moving_colors]
+    move_table = build_move_table(new_grid)
+
+    if budget is None:
+        budget = SearchBudget()
+    start_time = time.time()
+    expanded = 0
+
+    depths = np.full((nb_robots, GRID_SIZE*GRID_SIZE), UNREACHED, dtype=np.uint8)
+    states = np.zeros((nb_robots, GRID_SIZE*GRID_SIZE), dtype=np.uint32)
+
+    def record(level: np.ndarray, depth: int):
+        for rank, shift in enumerate(shifts):
+            cases, first = np.unique((level >> shift) & ROBOT_MASK, return_index=True)
+            new = depths[rank, cases] == UNREACHED
+            depths[rank, cases[new]] = depth
+            states[rank, cases[new]] = level[first[new]]
+
+    initial = pack_state(initial_state)
+    levels = SortedLevels()
+    to_see = np.array([initial], dtype=np.uint32)
+    levels.append(to_see, np.array([encode_move(0, 0, 0)], dtype=np.uint8))
+    record(to_see, 0)
+
+    stop = None
+    depth = 1
+    while depth < rec and len(to_see):
+        count_level("explore_all_targets", depth - 1, len(to_see))
+        nb_successors = len(to_see)*len(moving_ranks)*len(DIRECTIONS)
+        stop = budget.exceeded(start_time, expanded + len(to_see),
+                               levels.nbytes + SUCCESSOR_BYTES*nb_successors)
+        if stop is not None:
+            break
+        expanded += len(to_see)
+
+        new_states, new_moves = [], []
+        for level_states, moves in successors(move_table, to_see, shifts, moving_ranks, depth):
+            new_states.append(level_states)
+            new_moves.append(moves)
+            stop = budget.exceeded(start_time, 0, 0)
+            if stop is not None:
+                break
+        if stop is not None:
+            break
+
+        to_see = levels.add_level(new_states, new_moves)
+        record(to_see, depth)
+        depth += 1
+
+    if not len(to_see):
+        depth = rec
+
+    shape = (nb_robots, GRID_SIZE, GRID_SIZE)
+    reverse_rays = build_reverse_rays(move_table, build_ray_masks(move_table))
+    return AllTargets(depths.reshape(shape), states.reshape(shape), depth - 1,
+                      stop or "exhausted", initial, levels, reverse_rays)
+
+
+def target_path(targets: AllTargets, dst: Tuple[int, int], color_dst: Color) -> Optional[List[Tuple[Color, Wall]]]:
+    """
+    Shortest path of the color_dst robot to dst from an explore_all_targets
+    table, None if it needs more than targets.depth moves
+    """
+    i, j = int(dst[0]), int(dst[1])
+    if targets.depths[color_dst.value, i, j] == UNREACHED:
+        return None
+
+    nb_robots = len(targets.depths)
+    moves = rebuild_moves(targets.levels, targets.initial, int(targets.states[color_dst.value, i, j]),
+                          targets.reverse_rays, nb_robots)
+    return moves_to_path(targets.initial, moves, nb_robots)
@@ -0,0 +1,169 @@
+"""
+Batch solver: extract and solve a set of board pictures on a pool of processes.
+
+    python batch.py images/ -q "Y 13 10" -q "r 1 16" -o results.jsonl
+    python batch.py manifest.jsonl -o results.jsonl
+
+The input is a directory of pictures, solved for the --query queries, or a
+manifest with one JSON object per line: {"image": "path.jpeg", "queries": ["Y 13 10"]}
+(paths relative to the manifest, the --query queries are used when "queries"
+is missing). Queries are "COLOR line column", cases are numbered from 1 as in
+the bot.
+
+The output has one JSON line per picture ("record": "board", robots positions,
+walls and durations of the extraction stages) followed by one line per query
+("record": "query", path, number of moves and solve duration).
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from PIL import Image
+
+from ai_robot.ai_robot import MAX_STORED_DEPTH, SearchBudget
+from image_extraction.Color import Color
+from main import parse_board, solve_board
+
+IMAGE_EXTENSIONS = (".jpeg", ".jpg", ".png")
+
+COLOR_LETTERS = {color.name[0]: color for color in Color}
+
+
+class BatchTask(NamedTuple):
+    image: str
+    queries: List[str]
+    rec: int
+    max_seconds: Optional[float]
+    draw_dir: Optional[str]
+
+
+def parse_query(query: str) -> Tuple[Color, Tuple[int, int]]:
+    """
+    "COLOR line column" to the color and the target case (numbered from 0)
+    """
+    words = query.replace(",", " ").split()
+    if len(words) != 3 or not words[0] or words[0][0].upper() not in COLOR_LETTERS:
+        raise ValueError(f"invalid query {query!r}, expected \"COLOR line column\"")
+    line, column = int(words[1]), int(words[2])
+    if not (1 <= line <= 16 and 1 <= column <= 16):
+        raise ValueError(f"invalid query {query!r}, lines and columns are in range 1 -> 16")
+    return COLOR_LETTERS[words[0][0].upper()], (line - 1, column - 1)
+
+
+def read_tasks(source: str, queries: List[str]) -> List[Tuple[str, List[str]]]:
+    """
+    (image path, queries) of a directory or of a JSONL manifest
+    """
+    if os.path.isdir(source):
+        return [(os.path.join(source, name), queries) for name in sorted(os.listdir(source))
+                if name.lower().endswith(IMAGE_EXTENSIONS)]
+
+    tasks = []
+    with open(source) as manifest:
+        for line in manifest:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            image = os.path.join(os.path.dirname(source), entry["image"])
+            tasks.append((image, entry.get("queries", queries)))
+    return tasks
+
+
+def solve_image(task: BatchTask) -> List[Dict[str, Any]]:
+    """
+    Records of the extraction of a picture and of each of its queries,
+    the prints of the solver go to stderr, not to the records
+    """
+    with contextlib.redirect_stdout(sys.stderr):
+        return solve_image_records(task)
+
+
+def solve_image_records(task: BatchTask) -> List[Dict[str, Any]]:
+    record = {"record": "board", "image": task.image}
+    timings: Dict[str, float] = {}
+    try:
+        start_time = time.time()
+        img = Image.open(task.image)
+        img.load()
+        timings["load"] = time.time() - start_time
+        board = parse_board(img, timings)
+    except Exception as error:
+        record.update(error=repr(error), timings=timings)
+        return [record]
+
+    record.update(state={color.name: [int(i) + 1, int(j) + 1] for color, (i, j) in board.state.items()},
+                  confidence={color.name: round(x, 3) for color, x in board.confidence.items()},
+                  walls=board.grid.astype(int).tolist(), timings=timings)
+    records = [record]
+
+    for query in task.queries:
+        record = {"record": "query", "image": task.image, "query": query}
+        records.append(record)
+        try:
+            color, target_pos = parse_query(query)
+        except ValueError as error:
+            record["error"] = str(error)
+            continue
+
+        output_path = None
+        if task.draw_dir is not None:
+            name = os.path.splitext(os.path.basename(task.image))[0]
+            output_path = os.path.join(
+                task.draw_dir, f"{name}-{color.name}-{target_pos[0] + 1}-{target_pos[1] + 1}.jpeg")
+
+        start_time = time.time()
+        try:
+            result = solve_board(board, color, target_pos, output_path,
+                                 rec=task.rec, budget=SearchBudget(max_seconds=task.max_seconds))
+        except Exception as error:
+            record.update(error=repr(error), timings={"solve": time.time() - start_time})
+            continue
+        record.update(color=color.name, target=[target_pos[0] + 1, target_pos[1] + 1],
+                      moves=None if result.path is None else len(result.path),
+                      path=None if result.path is None else [[c.name, d.name] for c, d in result.path],
+                      depth=result.depth, stop=result.stop,
+                      timings={"solve": time.time() - start_time})
+
+    return records
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Extract and solve a set of board pictures")
+    parser.add_argument("source", help="directory of pictures or JSONL manifest")
+    parser.add_argument("-q", "--query", action="append", default=[],
+                        help="query \"COLOR line column\" (repeatable)")
+    parser.add_argument("-o", "--output", default="-", help="output JSONL file (default: stdout)")
+    parser.add_argument("-p", "--processes", type=int, default=None,
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--max-moves", type=int, default=10, help="longest solution searched")
+    parser.add_argument("--max-seconds", type=float, default=None, help="time limit of each query")
+    parser.add_argument("--draw", default=None, help="directory where the solutions are drawn")
+    args = parser.parse_args(argv)
+    if not 0 <= args.max_moves <= MAX_STORED_DEPTH:
+        parser.error(f"--max-moves must be in range 0 -> {MAX_STORED_DEPTH}")
+
+    if args.draw is not None:
+        os.makedirs(args.draw, exist_ok=True)
+    tasks = [BatchTask(image, queries, args.max_moves + 1, args.max_seconds, args.draw)
+             for image, queries in read_tasks(args.source, args.query)]
+
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        with Pool(args.processes) as pool:
+            # imap keeps the input order, so that two runs can be compared line by line
+            for records in pool.imap(solve_image, tasks):
+                for record in records:
+                    output.write(json.dumps(record) + "\n")
+                output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Benchmark of the solver engines on random boards (see tools/board_generator.py).
+
+    python benchmark.py --engines search_v3 vectorized --depths 6 8 --boards 5 -o benchmark.json
+
+Each run is done in a new process, to measure its peak memory. Two modes:
+- solve: a query solvable within the depth (one of the farthest cases the
+  robot reaches alone), the time to the first solution is measured
+- exhaust: an unreachable target, the whole tree of the depth is explored,
+  to measure the number of expanded states per second (BFS engines only)
+
+The results (one entry per run, and a summary per engine, mode and depth)
+are written as JSON with the versions and commit they were measured on.
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import random
+import resource
+import subprocess
+import time
+from functools import partial
+from multiprocessing import Pipe, Process, cpu_count
+from statistics import median
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+from ai_robot.ai_robot import (GRID_SIZE, MAX_STORED_DEPTH, SearchBudget,
+                               SearchResult, explore_bidirectional,
+                               explore_v2, ida_star, optimal_search, search_v3,
+                               transform_grid, transform_state_v2)
+from ai_robot.distance_maps import robot_distances
+from ai_robot.parallel_explore import explore_parallel
+from ai_robot.vectorized_explore import search_vectorized
+from image_extraction.Color import Color
+from tools.board_generator import CENTER, random_board
+
+
+def path_engine(explore: Callable, new_grid, initial_state, dst, color_dst, rec: int, budget: SearchBudget) -> SearchResult:
+    """
+    SearchResult of the engines only returning a path, expanded is unknown
+    """
+    path = explore(new_grid, initial_state, dst, color_dst, rec=rec)
+    if path is None:
+        return SearchResult(None, rec - 1, -1, "exhausted")
+    return SearchResult(path, len(path), -1, "solved")
+
+
+def optimal_engine(new_grid, initial_state, dst, color_dst, rec: int, budget: SearchBudget) -> SearchResult:
+    return optimal_search(new_grid, initial_state, dst, color_dst, rec_depths=(rec,)*len(Color),
+                          budget=budget, search=search_vectorized)
+
+
+class Engine(NamedTuple):
+    search: Callable[..., SearchResult]
+    exhaustive: bool  # explores the whole tree when the target is unreachable
+
+
+ENGINES: Dict[str, Engine] = {
+    "explore_v2": Engine(partial(path_engine, explore_v2), True),
+    "search_v3": Engine(search_v3, True),
+    "search_v3_canonical": Engine(partial(search_v3, canonical=True), True),
+    "vectorized": Engine(search_vectorized, True),
+    "parallel": Engine(partial(path_engine, explore_parallel), True),
+    "bidirectional": Engine(partial(path_engine, explore_bidirectional), False),
+    "ida_star": Engine(partial(path_engine, ida_star), False),
+    "optimal": Engine(optimal_engine, False),
+}
+
+DEFAULT_ENGINES = ["search_v3", "search_v3_canonical", "vectorized",
+                   "bidirectional", "optimal"]
+
+
+class BenchCase(NamedTuple):
+    engine: str
+    mode: str
+    seed: int
+    depth: int
+    max_seconds: Optional[float]
+
+
+def run_case(case: BenchCase) -> Dict[str, Any]:
+    grid, state = random_board(case.seed)
+    new_grid = transform_grid(grid)
+    state_v2 = transform_state_v2(state)
+
+    rnd = random.Random(case.seed)
+    color = rnd.choice(list(Color))
+    if case.mode == "exhaust":
+        dst = (CENTER[0], CENTER[0])
+    else:
+        i, j = state[color]
+        distances = robot_distances(new_grid, state_v2)[color.value, i*GRID_SIZE + j]
+        farthest = distances[distances <= case.depth].max()
+        dst = divmod(rnd.choice(np.flatnonzero(distances == farthest).tolist()), GRID_SIZE)
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = ENGINES[case.engine].search(new_grid, state_v2, dst, color, rec=case.depth + 1,
+                                             budget=SearchBudget(max_seconds=case.max_seconds))
+    seconds = time.perf_counter() - start_time
+
+    return {**case._asdict(), "color": color.name, "target": list(dst),
+            "seconds": seconds, "expanded": None if result.expanded < 0 else result.expanded,
+            "states_per_second": None if result.expanded < 0 else result.expanded / seconds,
+            "stop": result.stop, "moves": None if result.path is None else len(result.path),
+            "baseline_rss_kb": baseline_rss,
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def send_case(case: BenchCase, sender):
+    sender.send(run_case(case))
+
+
+def run_isolated(case: BenchCase) -> Dict[str, Any]:
+    """
+    run_case in a new process, so that ru_maxrss is the peak of this run only.
+    A run whose process dies (exception, out of memory) is recorded as failed
+    """
+    receiver, sender = Pipe(duplex=False)
+    process = Process(target=send_case, args=(case, sender))
+    process.start()
+    # the child holds the only sender, recv fails instead of waiting forever if it dies
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None:
+        return {**case._asdict(), "stop": "failed", "exitcode": process.exitcode,
+                "seconds": None, "expanded": None, "states_per_second": None,
+                "moves": None, "peak_rss_kb": None}
+    return result
+
+
+def summarize(runs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    groups: Dict[tuple, List[Dict[str, Any]]] = {}
+    for run in runs:
+        groups.setdefault((run["engine"], run["mode"], run["depth"]), []).append(run)
+
+    summary = []
+    for (engine, mode, depth), all_runs in groups.items():
+        group = [run for run in all_runs if run["stop"] != "failed"]
+        expanded = [run["expanded"] for run in group if run["expanded"] is not None]
+        summary.append({
+            "engine": engine, "mode": mode, "depth": depth, "runs": len(all_runs),
+            "failed": len(all_runs) - len(group),
+            "median_seconds": median(run["seconds"] for run in group) if group else None,
+            "states_per_second": sum(expanded) / sum(run["seconds"] for run in group) if expanded else None,
+            "max_peak_rss_kb": max(run["peak_rss_kb"] for run in group) if group else None,
+            "solved": sum(run["stop"] == "solved" for run in group),
+        })
+    return summary
+
+
+def metadata() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"date": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": commit,
+            "python": platform.python_version(), "numpy": np.__version__,
+            "platform": platform.platform(), "cpu_count": cpu_count()}
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Benchmark the solver engines on random boards")
+    parser.add_argument("--engines", nargs="+", default=DEFAULT_ENGINES, choices=sorted(ENGINES))
+    parser.add_argument("--modes", nargs="+", default=["solve", "exhaust"], choices=["solve", "exhaust"])
+    parser.add_argument("--depths", nargs="+", type=int, default=[6, 8],
+                        help="maximum number of moves of the searches")
+    parser.add_argument("--boards", type=int, default=3, help="number of random boards")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first board")
+    parser.add_argument("--max-seconds", type=float, default=None, help="time limit of each run")
+    parser.add_argument("-o", "--output", default="benchmark.json")
+    args = parser.parse_args(argv)
+    if not all(1 <= depth <= MAX_STORED_DEPTH for depth in args.depths):
+        parser.error(f"--depths must be in range 1 -> {MAX_STORED_DEPTH}")
+
+    runs = []
+    for engine in args.engines:
+        for mode in args.modes:
+            if mode == "exhaust" and not ENGINES[engine].exhaustive:
+                continue
+            for depth in args.depths:
+                for seed in range(args.seed, args.seed + args.boards):
+                    run = run_isolated(BenchCase(engine, mode, seed, depth, args.max_seconds))
+                    runs.append(run)
+                    if run["stop"] == "failed":
+                        print(f"{engine:20} {mode:8} depth {depth:2} seed {seed:3}: failed, exit code {run['exitcode']}")
+                        continue
+                    print(f"{engine:20} {mode:8} depth {depth:2} seed {seed:3}: {run['seconds']:8.3f} s, "
+                          f"{run['stop']:9} peak RSS {run['peak_rss_kb'] / 1024:7.1f} MB")
+
+    with open(args.output, "w") as output:
+        json.dump({"meta": metadata(), "summary": summarize(runs), "runs": runs}, output, indent=1)
+
+
+if __name__ == "__main__":
+    main()
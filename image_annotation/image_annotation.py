@@ -2,9 +2,10 @@ import time
 from typing import Any, Dict, List, Optional, Tuple
 
 import cv2
-import matplotlib.pyplot as plt
 import numpy as np
-from ai_robot.ai_robot import move_v4, transform_grid, transform_state_v2
+from ai_robot.ai_robot import (GRID_SIZE, build_move_table, build_ray_masks,
+                               move_v5, occupancy_mask, transform_grid,
+                               transform_state_v2)
 from image_extraction.board_extraction import (Orientation, extract_board,
                                                perspective_transform)
 from image_extraction.Color import Color
@@ -45,11 +46,16 @@ def draw(path, board_img, state, new_grid):
         offsets[color] = 32*((i+1)/(n+1) - 1/2)
     print(offsets)
 
+    move_table = build_move_table(new_grid).tolist()
+    ray_masks = build_ray_masks(move_table)
+
     moves = []
     for i, (color, direction) in enumerate(path):
-        start = tuple([np.uint8(x) for x in state[color]])
-        end = move_v4(new_grid, start, direction.value,
-                      transform_state_v2(state))
+        start = tuple(int(x) for x in state[color])
+        occupancy = occupancy_mask(
+            int(y)*GRID_SIZE + int(x) for y, x in state.values())
+        end = divmod(move_v5(move_table, ray_masks, start[0]*GRID_SIZE + start[1],
+                             direction.rank(), occupancy), GRID_SIZE)
         state[color] = end
         moves.append((i, color, direction, start, end))
 
@@ -93,3 +99,42 @@ def draw(path, board_img, state, new_grid):
                         lineType=lineType)
 
     return out
+
+
+def draw_difficulty_map(depths: np.ndarray, board_img: np.ndarray, max_depth: int, unreached: int = 255) -> np.ndarray:
+    """
+    Color each case of the board by the optimal number of moves of a robot
+    to reach it (depths, a 16x16 table of explore_all_targets), cases not
+    reached within max_depth moves are left gray
+    """
+    scaled = (np.minimum(depths, max_depth) * (255 // max(max_depth, 1))).astype(np.uint8)
+    colors = np.ascontiguousarray(
+        cv2.applyColorMap(scaled, cv2.COLORMAP_JET)[..., ::-1])
+    colors[depths == unreached] = 128
+    tiles = cv2.resize(colors, board_img.shape[1::-1],
+                       interpolation=cv2.INTER_NEAREST)
+    out = cv2.addWeighted(board_img, .5, tiles, .5, 0)
+
+    for i in range(depths.shape[0]):
+        for j in range(depths.shape[1]):
+            text = "-" if depths[i, j] == unreached else str(depths[i, j])
+            x, y = img_coord_from_case((i, j))
+            for thickness, fontColor in zip([4, 1], [(0, 0, 0), (255, 255, 255)]):
+                cv2.putText(img=out, text=text, org=(x - 5*len(text), y + 6),
+                            fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=.5,
+                            color=fontColor, thickness=thickness,
+                            lineType=cv2.LINE_AA)
+
+    return out
+
+
+def encode_image(img: np.ndarray, ext: str = ".jpeg", quality: int = 90) -> bytes:
+    """
+    Encode an RGB image (e.g. the output of draw) in the format of the
+    extension, in memory
+    """
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality] if ext.lower() in (".jpeg", ".jpg") else []
+    ok, buffer = cv2.imencode(ext, cv2.cvtColor(img, cv2.COLOR_RGB2BGR), params)
+    if not ok:
+        raise ValueError(f"could not encode the image as {ext}")
+    return buffer.tobytes()
@@ -1,12 +1,23 @@
 from enum import IntEnum, unique
-from typing import Any, Dict, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import cv2
-import matplotlib.pyplot as plt
 import numpy as np
 from PIL import Image
-from tools.geometry import angular_dist_modulo, intersection
-from tools.kruskal import kruskal_groups
+from tools.circular_clustering import circular_groups
+from tools.geometry import intersection
+
+
+# largest side of the pictures found at full resolution by parse_board
+# (Telegram sends photos of at most 1280 pixels), of the copy the board of
+# larger pictures is found on in extract_board, and HoughLines threshold on
+# this copy (the votes of a long line slightly out of the 1 degree bins do not
+# grow with its length, they are not scaled)
+LARGE_PHOTO_SIZE = 2000
+COARSE_SIZE = 1024
+COARSE_HOUGH_THRESHOLD = 120
+# side of the windows of the warped board where its corners are searched
+CORNER_SIZE = 48
 
 
 @unique
@@ -17,23 +28,55 @@ class Orientation(IntEnum):
     TOP_RIGHT = 3
 
 
-def extract_board(board: Union[np.ndarray, Any], square_size: int = 512) -> np.ndarray:
+def extract_board(board: Union[np.ndarray, Any], square_size: int = 512, max_size: Optional[int] = None) -> np.ndarray:
+    """
+    Extract the board game image from a picture. If the picture is larger than
+    max_size, the board is found on a copy downscaled to COARSE_SIZE, its
+    corners are refined on the full resolution picture and the picture is
+    warped once
+    """
+    img = np.array(board)
+    if max_size is None or max(img.shape[:2]) <= max_size:
+        # extract board first version
+        dst = perspective_transform(board_corners(img), img, square_size)
+
+        # refine board extraction by finding the board corners
+        return refine_board_extraction(dst, n_times=1)
+
+    scale = COARSE_SIZE / max(img.shape[:2])
+    small = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    corners = [(x / scale, y / scale) for x, y in board_corners(small, hough_threshold=COARSE_HOUGH_THRESHOLD)]
+    matrix = perspective_matrix(corners, square_size)
+
+    # corners of the warped board, the four corner windows only are warped
+    windows = np.zeros((square_size, square_size, *img.shape[2:]), dtype=img.dtype)
+    for top in (0, square_size - CORNER_SIZE):
+        for left in (0, square_size - CORNER_SIZE):
+            shift = np.array([[1, 0, -left], [0, 1, -top], [0, 0, 1]], dtype=np.float64)
+            windows[top:top + CORNER_SIZE, left:left + CORNER_SIZE] = cv2.warpPerspective(
+                img, shift @ matrix, (CORNER_SIZE, CORNER_SIZE))
+    new_corners = list(extract_all_corners(windows).values())
+
+    return cv2.warpPerspective(img, perspective_matrix(new_corners, square_size) @ matrix,
+                               (square_size, square_size))
+
+
+def board_corners(img: np.ndarray, hough_threshold: int = 200) -> List[Tuple[int, int]]:
     """
-    Extract the board game image from a picture
+    Corners of the board in the picture, from its longest lines
     """
 
     # extract the lines of the image
-    gray = cv2.cvtColor(np.array(board), cv2.COLOR_BGR2GRAY)
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     blur = cv2.GaussianBlur(gray, (7, 7), 0)
     edges = cv2.Canny(blur, 50, 150, apertureSize=3)
-    lines = cv2.HoughLines(edges, 1, 1*np.pi/180, 200)
+    lines = cv2.HoughLines(edges, 1, 1*np.pi/180, hough_threshold)
     lines = [x[0] for x in lines]
     rhos = [x[0] for x in lines]
     thetas = [x[1] for x in lines]
 
     # filter roughly the biggest group of orthogonal lines
-    keep = set(kruskal_groups(thetas, lambda a, b: angular_dist_modulo(
-        a, b, angle=np.pi/2), 1, d_max=30*np.pi/180)[0])
+    keep = set(circular_groups(thetas, np.pi/2, 1, d_max=30*np.pi/180)[0])
     remove_filter = [t not in keep for t in thetas]
     rhos = [rho for (rho, rem) in zip(rhos, remove_filter) if not rem]
     thetas = [theta for (theta, rem) in zip(thetas, remove_filter) if not rem]
@@ -41,8 +84,7 @@ def extract_board(board: Union[np.ndarray, Any], square_size: int = 512) -> np.n
     # label horizontal lines, vertical lines, and outliers
     ori = [theta % np.pi for theta in thetas]
     ori_reshape = np.array(ori).reshape(-1, 1)
-    s1, s2 = kruskal_groups(ori, lambda a, b: angular_dist_modulo(
-        a, b, angle=np.pi), 2, d_max=3*np.pi/180)[:2]
+    s1, s2 = circular_groups(ori, np.pi, 2, d_max=3*np.pi/180)[:2]
     remove_filter_group = [((x not in s1) and (x not in s2)) for x in ori]
     predicted_classes = [1 if x in s2 else 0 for x in ori]
     cluster_centers = list(s1)[0], list(s2)[0]
@@ -89,16 +131,13 @@ def extract_board(board: Union[np.ndarray, Any], square_size: int = 512) -> np.n
     pts.append(intersection(final_lines[0], final_lines[3]))
     pts.append(intersection(final_lines[3], final_lines[1]))
 
-    # extract board first version
-    dst = perspective_transform(pts, board, square_size)
+    return pts
 
-    # refine board extraction by finding the board corners
-    final_board = refine_board_extraction(dst, n_times=1)
 
-    return final_board
-
-
-def perspective_transform(points, img, square_size):
+def perspective_matrix(points, square_size: int) -> np.ndarray:
+    """
+    Perspective transform of the four corners of the board to a square
+    """
 
     p1 = [min((pt[0]+pt[1], pt) for pt in points)[1]]
     p4 = [max((pt[0]+pt[1], pt) for pt in points)[1]]
@@ -111,7 +150,12 @@ def perspective_transform(points, img, square_size):
     pts1 = np.float32(pts_ordered)
     pts2 = np.float32([[0, 0], [square_size, 0], [0, square_size],
                        [square_size, square_size]])
-    M = cv2.getPerspectiveTransform(pts1, pts2)
+    return cv2.getPerspectiveTransform(pts1, pts2)
+
+
+def perspective_transform(points, img, square_size):
+
+    M = perspective_matrix(points, square_size)
     dst = cv2.warpPerspective(np.array(img), M, (square_size, square_size))
 
     return dst
@@ -173,7 +217,7 @@ def get_corner_coord(corner_image: np.ndarray, angle_type: Orientation, padding_
 def extract_all_corners(board: np.ndarray) -> Dict[Orientation, Tuple[int, int]]:
 
     h, w = board.shape[:2]
-    corner_size = 48
+    corner_size = CORNER_SIZE
     coords = {}
     coords[Orientation.TOP_LEFT] = get_corner_coord(
         board[:corner_size, :corner_size, :], Orientation.TOP_LEFT)
@@ -194,6 +238,8 @@ def extract_all_corners(board: np.ndarray) -> Dict[Orientation, Tuple[int, int]]
 if __name__ == "__main__":
 
     import time
+
+    import matplotlib.pyplot as plt
     board = Image.open("images/plateau2.jpeg")
     start_time = time.time()
     extracted_board = extract_board(board)
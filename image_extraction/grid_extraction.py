@@ -4,8 +4,8 @@ from enum import IntFlag, unique
 from typing import Dict, List, Tuple
 
 import cv2
-import matplotlib.pyplot as plt
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 from PIL import Image
 
 from image_extraction.board_extraction import extract_board
@@ -13,43 +13,54 @@ from image_extraction.Color import Color, HSV_BOUNDERIES
 from image_extraction.Wall import Wall
 
 
-def case_match(black_white_board: np.ndarray, template: np.ndarray, threshold: float = .89) -> List[Tuple[int, int]]:
-
+def case_match(black_white_board: np.ndarray, template: np.ndarray, threshold: float = .89) -> np.ndarray:
+    """
+    Boolean grid of the cases with a match of the template at their top left corner
+    """
     if np.sum(black_white_board == 255) > np.sum(black_white_board == 0):
         black_white_board = 255 - black_white_board
 
-    matched_cases = set()
     res = cv2.matchTemplate(black_white_board, template, cv2.TM_CCORR_NORMED)
-    loc = np.where(res >= threshold)
-    for pt in zip(*loc):
-        d = (round(float(pt[0])*16/512), round(float(pt[1])*16/512))
-        matched_cases.add(d)
+    ys, xs = np.nonzero(res >= threshold)
+    # one more line and column for the hits rounded to the outer walls
+    hits = np.zeros((17, 17), dtype=bool)
+    hits[np.round(ys*16/512).astype(int), np.round(xs*16/512).astype(int)] = True
+
+    return hits[:16, :16]
+
+
+def tile_interiors(size: int = 512, grid_size: int = 16, zoom: float = .76) -> np.ndarray:
+    """
+    Mask of the center of each tile, on a side of zoom times the tile size
+    """
+    tile_size = size//grid_size
+    half_cache_size = int(round(zoom*tile_size//2))
+    offsets = np.arange(size) % tile_size - tile_size//2
+    inside = (-half_cache_size <= offsets) & (offsets < half_cache_size)
+    return inside[:, None] & inside[None, :]
 
-    return list(matched_cases)
 
+TILE_INTERIORS = tile_interiors()
 
-def get_wall_grid(board: np.ndarray) -> np.ndarray:
 
-    # Put image in black and white to match walls
-    board2 = cv2.bilateralFilter(board, 19, 75, 75)
-    #hsv = cv2.cvtColor(board2, cv2.COLOR_BGR2HSV)
-    gray = cv2.cvtColor(board2, cv2.COLOR_BGR2GRAY)
+def get_wall_grid(board: np.ndarray, color_filter: bool = False) -> np.ndarray:
+
+    # Put image in black and white to match walls, the first filter was
+    # applied on the colors before, as accurate but 6 times slower
+    if color_filter:
+        gray = cv2.cvtColor(cv2.bilateralFilter(board, 19, 75, 75), cv2.COLOR_BGR2GRAY)
+    else:
+        gray = cv2.bilateralFilter(cv2.cvtColor(board, cv2.COLOR_BGR2GRAY), 19, 75, 75)
     blur = cv2.bilateralFilter(gray, 3, 75, 75)
     thresh = cv2.adaptiveThreshold(
         blur, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 21, 15)
 
     # Mask the content of the tiles at x%
-    tile_size = 32
-    zoom = 0.76
-    half_cache_size = int(round(zoom*tile_size//2))
-    for i in range(16):
-        for j in range(16):
-            y, x = int((i+.5)*tile_size), int((j+.5)*tile_size)
-            thresh[y-half_cache_size:y+half_cache_size,
-                   x-half_cache_size:x+half_cache_size] = 255
+    thresh[TILE_INTERIORS] = 255
 
     # TODO improve idea
     # # Mask colorful objects of the board
+    # hsv = cv2.cvtColor(board, cv2.COLOR_BGR2HSV)
     # mask = np.zeros(hsv.shape[:2], dtype=np.uint8)
     # for color, boundery in HSV_BOUNDERIES.items():
     #     mask |= cv2.inRange(hsv, boundery["lower"], boundery["upper"])
@@ -85,38 +96,42 @@ def get_wall_grid(board: np.ndarray) -> np.ndarray:
     horizontal_template = np.rot90(vertical_template, 1)
 
     # Add vertical walls in the grid
-    for y, x in case_match(edges2, vertical_template):
-        grid[y][x] |= Wall.LEFT
-        if x > 0:
-            grid[y][x-1] |= Wall.RIGHT
+    vertical = case_match(edges2, vertical_template)
+    grid[vertical] |= Wall.LEFT
+    grid[:, :-1][vertical[:, 1:]] |= Wall.RIGHT
 
     # Add horizontal walls in the grid
-    for y, x in case_match(edges2, horizontal_template):
-        grid[y][x] |= Wall.TOP
-        if y > 0:
-            grid[y-1][x] |= Wall.BOTTOM
+    horizontal = case_match(edges2, horizontal_template)
+    grid[horizontal] |= Wall.TOP
+    grid[:-1][horizontal[1:]] |= Wall.BOTTOM
 
     # TODO improve matching with edges
 
     return grid
 
 
-def split_board(board: np.ndarray, grid_size: int = 16, zoom: float = 1.) -> np.ndarray:
-
+def tile_view(board: np.ndarray, grid_size: int = 16, zoom: float = 1.) -> np.ndarray:
+    """
+    Read-only view of the tiles of the board, shape (grid_size, grid_size,
+    tile, tile, channels): each case zoomed around its center, the tiles
+    overlap when zoom > 1 and the board is padded with black on its borders
+    (the board is only copied for this padding)
+    """
     tile_size = board.shape[0]//grid_size
     extra = 2*int(((zoom-1)*tile_size)//2)
-    board_grid = np.zeros((grid_size, grid_size, tile_size + extra,
-                           tile_size+extra, *board.shape[2:]), dtype=np.uint8)
+    if extra > 0:
+        padding = ((extra//2, extra//2),)*2 + ((0, 0),)*(board.ndim - 2)
+        board = np.pad(board, padding)
+    else:
+        board = board[-extra//2:, -extra//2:]
 
-    for i in range(grid_size):
-        for j in range(grid_size):
-            try:
-                board_grid[i, j, :, :, :] = board[max(0, i*tile_size-extra//2):(i+1)*tile_size + extra//2,
-                                                  max(0, j*tile_size-extra//2):(j+1)*tile_size + extra//2, :]
-            except:
-                pass
+    strides = (tile_size*board.strides[0], tile_size*board.strides[1]) + board.strides
+    return as_strided(board, shape=(grid_size, grid_size, tile_size + extra, tile_size + extra, *board.shape[2:]),
+                      strides=strides, writeable=False)
 
-    return board_grid
+
+def split_board(board: np.ndarray, grid_size: int = 16, zoom: float = 1.) -> np.ndarray:
+    return tile_view(board, grid_size, zoom)
 
 
 def get_bot_location(board_grid: np.ndarray) -> Dict[str, Tuple[int, int]]:
@@ -139,6 +154,45 @@ def get_bot_location(board_grid: np.ndarray) -> Dict[str, Tuple[int, int]]:
     return bot_pos
 
 
+def tile_bounds(size: int, grid_size: int = 16, zoom: float = 1.) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    First and last (excluded) pixels of the tiles of tile_view along one axis,
+    without the padding
+    """
+    tile_size = size//grid_size
+    extra = 2*int(((zoom-1)*tile_size)//2)
+    starts = np.arange(grid_size)*tile_size - extra//2
+    return np.clip(starts, 0, size), np.clip(starts + tile_size + extra, 0, size)
+
+
+def locate_bots(board: np.ndarray, grid_size: int = 16, zoom: float = .6) -> Tuple[Dict[Color, Tuple[int, int]], Dict[Color, float]]:
+    """
+    Same as get_bot_location(split_board(board, grid_size, zoom)), from one
+    HSV conversion of the board and the integral image of the color masks.
+    Also returns the confidence of each position: (best - second best tile
+    score) / best score, 0 when two tiles are as likely
+    """
+    hsv = cv2.cvtColor(board, cv2.COLOR_BGR2HSV)
+    masks = np.stack([cv2.inRange(hsv, HSV_BOUNDERIES[color]["lower"], HSV_BOUNDERIES[color]["upper"]) // 255
+                      for color in Color], axis=-1)
+    integral = cv2.integral(masks)
+
+    starts, ends = tile_bounds(board.shape[0], grid_size, zoom)
+    # number of pixels of each color in each tile, shape (colors, grid_size, grid_size)
+    scores = (integral[ends[:, None], ends] - integral[starts[:, None], ends]
+              - integral[ends[:, None], starts] + integral[starts[:, None], starts]).transpose(2, 0, 1)
+    scores[:, 7:10, 7:10] = -1
+
+    bot_pos, confidence = {}, {}
+    for color, color_scores in zip(Color, scores.reshape(len(Color), -1)):
+        # last best tile, as the sort of get_bot_location
+        best = color_scores.size - 1 - int(np.argmax(color_scores[::-1]))
+        bot_pos[color] = divmod(best, grid_size)
+        first, second = np.partition(color_scores, -2)[-1:-3:-1]
+        confidence[color] = float((first - second) / first) if first > 0 else 0.
+    return bot_pos, confidence
+
+
 def pretty_print(grid: np.ndarray, size: int = 4) -> Tuple[str, np.ndarray]:
     blank = "░"
     full = "▓"
@@ -175,6 +229,8 @@ if __name__ == "__main__":
 
     import time
 
+    import matplotlib.pyplot as plt
+
     names = ["plateau", "plateau2", "board2", "board22", "board222"]
 
     plt.figure(figsize=(3*len(names), 6))
@@ -1,48 +1,284 @@
+import os
+import threading
 import time
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 
 import cv2
-import matplotlib.pyplot as plt
 import numpy as np
 from PIL import Image
 
-from ai_robot.ai_robot import explore_v2, transform_grid, transform_state_v2
-from image_annotation.image_annotation import draw
-from image_extraction.board_extraction import (Orientation, extract_board,
+from ai_robot.ai_robot import (GRID_SIZE, SearchBudget, SearchResult,
+                               transform_grid, transform_state_v2)
+from ai_robot.distance_maps import (UNREACHABLE, relaxed_distances,
+                                    robot_distances)
+from ai_robot.solve_cache import SolveCache, board_key, image_key, query_key
+from ai_robot.vectorized_explore import (AllTargets, explore_all_targets,
+                                         explore_vectorized, search_vectorized,
+                                         target_path)
+from image_annotation.image_annotation import (draw, draw_difficulty_map,
+                                               encode_image)
+from image_extraction.board_extraction import (LARGE_PHOTO_SIZE, Orientation,
+                                               extract_board,
                                                perspective_transform)
-from image_extraction.Color import Color
-from image_extraction.grid_extraction import (get_bot_location, get_wall_grid,
-                                              pretty_print, split_board)
+from image_extraction.Color import Color, revert_color_value
+from image_extraction.grid_extraction import (get_wall_grid, locate_bots,
+                                              pretty_print)
 from image_extraction.Wall import Wall
+from tools.instrumentation import timer, trace
 
-plt.switch_backend('Agg')
+# save the images as matplotlib figures, as before the direct encoding
+DEBUG_FIGURES = os.environ.get("DEBUG_FIGURES", "0") == "1"
+PLOT_LOCK = threading.Lock()
 
+# extracted boards of the last input images, and results of the last queries
+# (stored in SOLVE_CACHE_DIR when set, to survive restarts)
+BOARD_CACHE = SolveCache(maxsize=16)
+SOLVE_CACHE = SolveCache(maxsize=1024, directory=os.environ.get("SOLVE_CACHE_DIR"))
+# explore_all_targets tables of the last boards (a few MB each)
+TARGETS_CACHE = SolveCache(maxsize=4)
 
-def solve(img, color=Color.YELLOW, target_pos=(8, 9), output_path="result.jpeg"):
 
-    board_game = extract_board(img)
-    grid = get_wall_grid(board_game)
-    board_tiles = split_board(board_game, zoom=.6)
-    state = get_bot_location(board_tiles)
+class Board(NamedTuple):
+    board_game: np.ndarray  # warped image of the board
+    grid: np.ndarray  # walls of each case
+    new_grid: np.ndarray  # transform_grid of the walls
+    state: Dict[Color, Tuple[int, int]]  # robots positions
+    robot_distances: np.ndarray  # robot_distances, upper bounds of the moves of each robot
+    relaxed_distances: np.ndarray  # relaxed_distances, lower bounds of the moves
+    confidence: Optional[Dict[Color, float]] = None  # of the robots positions, see locate_bots
+
+
+def build_board(board_game: np.ndarray, grid: np.ndarray, state: Dict[Color, Tuple[int, int]],
+                confidence: Optional[Dict[Color, float]] = None) -> Board:
+    """
+    Board of an extracted grid and state, with its distance maps
+    """
     new_grid = transform_grid(grid)
-    state_v2 = transform_state_v2(state)
-    path = explore_v2(new_grid, state_v2, target_pos, color,
-                      moving_colors=None, rec=11)
+    return Board(board_game, grid, new_grid, state,
+                 robot_distances(new_grid, transform_state_v2(state)),
+                 relaxed_distances(new_grid), confidence)
 
-    if path is not None:
+
+def parse_board(img, timings: Optional[Dict[str, float]] = None) -> Board:
+    """
+    Run the whole extraction pipeline on a picture of the board,
+    the duration of each stage is added to timings if given
+    """
+    with trace() as stages:
+        with timer("extract_board"):
+            board_game = extract_board(img, max_size=LARGE_PHOTO_SIZE)
+        with timer("get_wall_grid"):
+            grid = get_wall_grid(board_game)
+        with timer("get_bot_location"):
+            state, confidence = locate_bots(board_game, zoom=.6)
+        with timer("distance_maps"):
+            board = build_board(board_game, grid, state, confidence)
+
+    if timings is not None:
+        timings.update(stages)
+    return board
+
+
+def save_board(board: Board, path: str):
+    """
+    Save a parsed board in a compressed .npz file
+    """
+    state = np.zeros((len(board.state), 2), dtype=np.uint8)
+    for color, pos in board.state.items():
+        state[color.value] = pos
+    confidence = {}
+    if board.confidence is not None:
+        confidence["confidence"] = np.array([board.confidence[color] for color in sorted(board.confidence)])
+    np.savez_compressed(path, board_game=board.board_game, grid=board.grid,
+                        new_grid=board.new_grid, state=state,
+                        robot_distances=board.robot_distances,
+                        relaxed_distances=board.relaxed_distances, **confidence)
+
+
+def load_board(path: str) -> Board:
+    with np.load(path) as data:
+        state = {revert_color_value(value): (int(i), int(j))
+                 for value, (i, j) in enumerate(data["state"])}
+        confidence = None
+        if "confidence" in data:
+            confidence = {revert_color_value(value): float(x)
+                          for value, x in enumerate(data["confidence"])}
+        if "relaxed_distances" not in data:
+            # saved before the distance maps
+            return build_board(data["board_game"], data["grid"], state, confidence)
+        # the lone_distances of older files are not used
+        return Board(data["board_game"], data["grid"], data["new_grid"], state,
+                     data["robot_distances"], data["relaxed_distances"], confidence)
+
+
+def query_bounds(board: Board, color: Color, target_pos: Tuple[int, int]) -> Tuple[int, int]:
+    """
+    Lower and upper bounds of the number of moves of the color robot to
+    target_pos (UNREACHABLE when there is no bound)
+    """
+    src = board.state[color][0]*GRID_SIZE + board.state[color][1]
+    dst = int(target_pos[0])*GRID_SIZE + int(target_pos[1])
+    return int(board.relaxed_distances[src, dst]), int(board.robot_distances[color.value, src, dst])
+
+
+def read_board(img) -> Board:
+    """
+    parse_board, run once per input image
+    """
+    key = image_key(img)
+    board = BOARD_CACHE.get(key)
+    if board is None:
+        board = parse_board(img)
+        BOARD_CACHE.put(key, board)
+    return board
+
+
+def cached_search(new_grid: np.ndarray, state_v2: Tuple[Tuple[int, int], ...], target_pos: Tuple[int, int], color: Color,
+                  rec: int, budget: SearchBudget) -> SearchResult:
+    """
+    search_vectorized with the results of the previous queries on the same
+    walls and robots positions. Only the final results are cached (solved or
+    exhausted), not the ones stopped by the budget.
+    """
+    key = query_key(new_grid, state_v2, target_pos, color)
+    result = SOLVE_CACHE.get(key)
+    if result is not None and (result.solved or result.depth >= rec - 1):
+        return result
+
+    result = search_vectorized(new_grid, state_v2, target_pos, color,
+                               moving_colors=None, rec=rec, budget=budget)
+    if result.stop in ("solved", "exhausted"):
+        SOLVE_CACHE.put(key, result)
+    return result
+
+
+def board_targets(board: Board, rec=11, budget=SearchBudget(max_seconds=20)) -> AllTargets:
+    """
+    explore_all_targets of a board, computed once per board
+    """
+    key = board_key(board.new_grid, transform_state_v2(board.state))
+    targets = TARGETS_CACHE.get(key)
+    if targets is None or (targets.depth < rec - 1 and targets.stop == "exhausted"):
+        targets = explore_all_targets(board.new_grid, transform_state_v2(board.state),
+                                      rec=rec, budget=budget)
+        if targets.stop != "cancelled":
+            TARGETS_CACHE.put(key, targets, persist=False)
+    return targets
+
+
+def save_image(img: np.ndarray, output_path: str, figure: bool = DEBUG_FIGURES):
+    """
+    Write the image in the format of the extension of output_path,
+    or as a 10x10 inches matplotlib figure if figure is True
+    """
+    if not figure:
+        with timer("save_image"):
+            data = encode_image(img, os.path.splitext(output_path)[1] or ".jpeg")
+            with open(output_path, "wb") as file:
+                file.write(data)
+        return
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    # pyplot figures are global, one thread at a time
+    with PLOT_LOCK, timer("save_figure"):
         plt.figure(figsize=(10, 10))
-        plt.imshow(draw(path, board_game, state, new_grid))
+        plt.imshow(img)
         plt.axis('off')
         plt.tight_layout()
         plt.savefig(output_path, optimize=True, dpi=150)
-        return True
+        plt.close()
+
+
+def solution_image(board: Board, path, ext: str = ".jpeg") -> bytes:
+    """
+    Encoded image of the path drawn on the board, e.g. to send it
+    without writing a file
+    """
+    with timer("draw"):
+        img = draw(path, board.board_game, dict(board.state), board.new_grid)
+    with timer("encode_image"):
+        return encode_image(img, ext)
+
+
+def difficulty_image(board: Board, targets: AllTargets, color=Color.YELLOW, ext: str = ".jpeg") -> bytes:
+    """
+    Encoded image of the number of moves of the color robot to each case
+    """
+    with timer("draw"):
+        img = draw_difficulty_map(targets.depths[color.value], board.board_game, targets.depth)
+    with timer("encode_image"):
+        return encode_image(img, ext)
+
+
+def solve(img, color=Color.YELLOW, target_pos=(8, 9), output_path="result.jpeg",
+          rec=11, budget=SearchBudget(max_seconds=20)) -> SearchResult:
+    return solve_board(read_board(img), color, target_pos, output_path, rec, budget)
 
-    print("No solution for now")
-    return False
+
+def solve_board(board: Board, color=Color.YELLOW, target_pos=(8, 9), output_path="result.jpeg",
+                rec=11, budget=SearchBudget(max_seconds=20)) -> SearchResult:
+    """
+    Same as solve, on an already parsed board (see parse_board and load_board),
+    the solution is not drawn if output_path is None
+    """
+    start_time = time.time()
+    lower, upper = query_bounds(board, color, target_pos)
+    if lower > rec - 1:
+        return SearchResult(None, rec - 1, 0, "exhausted")
+
+    # one BFS answers all the queries of the board, the targets further than
+    # the depth it reached within the budget are searched alone
+    with timer("all_targets"):
+        targets = board_targets(board, rec, budget)
+        path = target_path(targets, target_pos, color)
+    if path is not None:
+        result = SearchResult(path, len(path), 0, "solved")
+    elif targets.stop == "exhausted" and targets.depth >= rec - 1:
+        result = SearchResult(None, targets.depth, 0, "exhausted")
+    else:
+        # the robot alone reaches the target in upper moves
+        if upper != UNREACHABLE:
+            rec = min(rec, upper + 1)
+        state_v2 = transform_state_v2(board.state)
+        # the budget is shared by the two searches
+        remaining = budget._replace(
+            max_seconds=None if budget.max_seconds is None else budget.max_seconds -
+            (time.time() - start_time))
+        with timer("search"):
+            result = cached_search(board.new_grid, state_v2,
+                                   target_pos, color, rec, remaining)
+
+    if not result.solved:
+        print("No solution for now")
+    elif output_path is not None:
+        with timer("draw"):
+            img = draw(result.path, board.board_game,
+                       dict(board.state), board.new_grid)
+        save_image(img, output_path)
+    return result
+
+
+def difficulty_map(board: Board, color=Color.YELLOW, output_path="map.jpeg",
+                   rec=11, budget=SearchBudget(max_seconds=20)) -> AllTargets:
+    """
+    Save the image of the number of moves of the color robot to each case,
+    the image is not drawn if output_path is None
+    """
+    with timer("all_targets"):
+        targets = board_targets(board, rec, budget)
+    if output_path is not None:
+        save_image(draw_difficulty_map(targets.depths[color.value], board.board_game,
+                                       targets.depth), output_path)
+    return targets
 
 
 if __name__ == "__main__":
 
+    import matplotlib.pyplot as plt
+
     names = ["plateau", "plateau2", "plateau3", "plateau4", "board222"]
     name = names[-1]
 
@@ -58,8 +294,7 @@ if __name__ == "__main__":
         grid[13, 8] |= Wall.LEFT | Wall.TOP
         grid[12, 8] |= Wall.BOTTOM
 
-    board_tiles = split_board(board_game, zoom=.6)
-    state = get_bot_location(board_tiles)
+    state, _ = locate_bots(board_game, zoom=.6)
 
     plt.figure(figsize=(12, 4))
     plt.subplot(1, 4, 1), plt.imshow(
@@ -73,8 +308,8 @@ if __name__ == "__main__":
 
     start_time = time.time()
     state_v2 = transform_state_v2(state)
-    path = explore_v2(new_grid, state_v2, (13, 9), Color.YELLOW,
-                      moving_colors=None, rec=14)
+    path = explore_vectorized(new_grid, state_v2, (13, 9), Color.YELLOW,
+                              moving_colors=None, rec=14)
 
     print(f"Exploration done in {(time.time()-start_time):.4} s")
 
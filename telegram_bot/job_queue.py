@@ -0,0 +1,103 @@
+import logging
+import threading
+from collections import deque
+from queue import Queue
+from typing import Callable, Deque, Dict, Hashable, Iterable, List
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    """
+    Call of function(*args, cancel=event) queued by JobQueue.submit,
+    the function should stop early once the cancel event is set
+    """
+
+    def __init__(self, kind: str, key: Hashable, function: Callable, args: tuple):
+        self.kind = kind
+        self.key = key
+        self.function = function
+        self.args = args
+        self.cancel = threading.Event()
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            if not self.cancel.is_set():
+                self.function(*self.args, cancel=self.cancel)
+        except Exception:
+            logger.exception(f"job {self.kind} {self.key} failed")
+        finally:
+            self.done.set()
+
+
+class JobQueue:
+    """
+    Runs the jobs on a pool of worker threads. The jobs of a chat run one at
+    a time, in submission order, the jobs of different chats in parallel.
+    A new job cancels the queued or running jobs of the same chat and kind,
+    unless it has the same key as the last one, which is then kept instead.
+    """
+
+    def __init__(self, workers: int = 1):
+        self.lock = threading.Lock()
+        self.chats: Dict[Hashable, Deque[Job]] = {}  # queued and running jobs
+        self.ready: Queue = Queue()  # chats with a job ready to run
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def submit(self, chat_id: Hashable, kind: str, key: Hashable, function: Callable, *args) -> Job:
+        with self.lock:
+            jobs = self.chats.setdefault(chat_id, deque())
+            same_kind = [job for job in jobs
+                         if job.kind == kind and not job.cancel.is_set()]
+            if same_kind and same_kind[-1].key == key:
+                return same_kind[-1]
+
+            for job in same_kind:
+                job.cancel.set()
+            job = Job(kind, key, function, args)
+            jobs.append(job)
+            if len(jobs) == 1:
+                self.ready.put(chat_id)
+            return job
+
+    def pending(self, chat_id: Hashable) -> List[Job]:
+        """
+        Queued and running jobs of a chat, not cancelled
+        """
+        with self.lock:
+            return [job for job in self.chats.get(chat_id, ()) if not job.cancel.is_set()]
+
+    def cancel(self, chat_id: Hashable, kinds: Iterable[str]):
+        """
+        Cancel the queued and running jobs of a chat of the given kinds
+        """
+        kinds = set(kinds)
+        with self.lock:
+            for job in self.chats.get(chat_id, ()):
+                if job.kind in kinds:
+                    job.cancel.set()
+
+    def __len__(self) -> int:
+        """
+        Number of queued and running jobs, of all the chats
+        """
+        with self.lock:
+            return sum(len(jobs) for jobs in self.chats.values())
+
+    def _work(self):
+        while True:
+            chat_id = self.ready.get()
+            with self.lock:
+                job = self.chats[chat_id][0]
+
+            job.run()
+
+            with self.lock:
+                jobs = self.chats[chat_id]
+                jobs.popleft()
+                if jobs:
+                    self.ready.put(chat_id)
+                else:
+                    del self.chats[chat_id]
@@ -1,19 +1,37 @@
+import functools
+import io
+import json
 import logging
 import os
-from typing import Tuple
+from typing import Callable, Tuple
 
 import telebot
-from flask import Flask, request
+from flask import Flask, jsonify, request
 from image_extraction.Color import Color
-from main import solve
+from ai_robot.ai_robot import SearchBudget
+from ai_robot.distance_maps import UNREACHABLE
+from main import (difficulty_image, difficulty_map, parse_board, query_bounds,
+                  solution_image, solve_board)
 from PIL import Image
+from telegram_bot.job_queue import JobQueue
+from telegram_bot.session import ChatSession, SessionStore
+from tools.instrumentation import METRICS, profiled, timer, trace
 
 TOKEN = str(os.environ.get("TOKEN", "where-is-my-token"))
-bot = telebot.TeleBot(TOKEN)
+# the handlers only queue the long jobs, so that the webhook answers at once
+bot = telebot.TeleBot(TOKEN, threaded=False)
 app = Flask(__name__)
+JOBS = JobQueue(workers=int(os.environ.get("SOLVER_WORKERS", 1)))
 
 SAVE_DIR = "telegram_files"
-os.makedirs(SAVE_DIR, exist_ok=True)
+SESSIONS = SessionStore(SAVE_DIR)
+
+# longest solution searched, and time limit of a query
+MAX_MOVES = 10
+MAX_SECONDS = 20
+
+COLOR_STRINGS = {"r": Color.RED, "b": Color.BLUE, "g": Color.GREEN,
+                 "y": Color.YELLOW}
 
 HELP_MESSAGE = ("Welcome to the ricochet-robot solver!\n\n"
 
@@ -28,8 +46,26 @@ HELP_MESSAGE = ("Welcome to the ricochet-robot solver!\n\n"
                 "3) Send a new request on the current picture with step 1) or send a new boardgame picture with step 1)\n\n\n"
 
                 "Ex: If you want to know how the BLUE robot can go to the TOP RIGHT corner, send \"BLUE 1 16\" (1 -> first line, 16 -> last column)\n\n"
+                "Send \"/map COLOR\" to get the number of moves of the COLOR robot to each case (the robot of the last query by default)\n\n"
                 "Pro Tips, \"YELLOW 12 5\", \"Y 12 5\", \"y 12 5\", \"y125\" are all accepted")
 
+
+def traced(event: str) -> Callable:
+    """
+    Decorator of the jobs: time their stages, log them as one JSON line
+    and profile the job if PROFILE_DIR is set
+    """
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(session: ChatSession, message, *args, cancel):
+            with trace() as stages, profiled(f"{event}-{message.chat.id}"), timer(event):
+                function(session, message, *args, cancel=cancel)
+            app.logger.info(json.dumps({"event": event, "chat": message.chat.id,
+                                        "cancelled": cancel.is_set(), "stages": stages}))
+        return wrapper
+    return decorator
+
+
 # handle commands, /start
 @bot.message_handler(commands=['start'])
 def start(message):
@@ -37,14 +73,52 @@ def start(message):
         message, f"Hello {message.from_user.first_name},\n" + HELP_MESSAGE)
 
 
+# handle /map COLOR, difficulty map of the current board
+@bot.message_handler(commands=['map'])
+def send_difficulty_map(message):
+    session = SESSIONS.get(message.chat.id)
+    words = message.text.split()[1:]
+    if words and words[0][0].lower() in COLOR_STRINGS:
+        color = COLOR_STRINGS[words[0][0].lower()]
+    elif not words and session.query is not None:
+        color = session.query[0]
+    else:
+        bot.reply_to(
+            message, "Send \"/map COLOR\", color available are RED, BLUE, GREEN and YELLOW")
+        return
+
+    if not session.has_board():
+        bot.reply_to(
+            message, "There is not previously sent picture of the board, please send a picture")
+        return
+
+    JOBS.submit(message.chat.id, "map", color, map_request,
+                session, message, color)
+
+
+@traced("map")
+def map_request(session: ChatSession, message, color, cancel):
+
+    board = session.board(cancel=cancel)
+    if cancel.is_set():
+        # a new picture was sent meanwhile
+        return
+    if board is None:
+        bot.reply_to(
+            message, "There is not previously sent picture of the board, please send a picture")
+        return
+
+    targets = difficulty_map(board, color, output_path=None,
+                             rec=MAX_MOVES + 1, budget=SearchBudget(max_seconds=MAX_SECONDS, cancel=cancel))
+    if targets.stop == "cancelled":
+        return
+    bot.send_photo(chat_id=message.chat.id,
+                   photo=difficulty_image(board, targets, color))
+
+
 # handle all messages, echo response back to users
 @bot.message_handler(func=lambda message: True, content_types=['text'])
 def handle_all_message(message):
-    global color
-    global target_pos
-
-    color_string_dict = {"r": Color.RED, "b": Color.BLUE, "g": Color.GREEN,
-                         "y": Color.YELLOW}
 
     try:
         color_string, y, x = match_query(message.text)
@@ -53,7 +127,7 @@ def handle_all_message(message):
             message, "Sorry, I don't understand your query, send /start to get some help")
         return
 
-    if color_string not in color_string_dict:
+    if color_string not in COLOR_STRINGS:
         bot.reply_to(
             message, "Wrong color, color available are RED, BLUE, GREEN and YELLOW")
         return
@@ -68,59 +142,115 @@ def handle_all_message(message):
             message, "Wrong target position, cannot reach cases in the center")
         return
 
-    color = color_string_dict[color_string]
-    target_pos = int(y-1), int(x-1)
-
-    input_image_path = f"{SAVE_DIR}/{message.chat.id}-input.jpg"
-    output_image_path = f"{SAVE_DIR}/{message.chat.id}-output.jpg"
+    session = SESSIONS.get(message.chat.id)
+    query = COLOR_STRINGS[color_string], (int(y-1), int(x-1))
+    session.query = query
 
-    if os.path.isfile(input_image_path):
-        solve_request(message, input_image_path, output_image_path)
-        return
-    else:
+    if not session.has_board():
         bot.reply_to(
             message, "There is not previously sent picture of the board, please send a picture")
         return
 
+    # a new query cancels the previous one of the chat, the same query is only run once
+    if any(job.kind == "solve" and job.key == query for job in JOBS.pending(message.chat.id)):
+        bot.reply_to(message, "Already working on this query, please wait")
+        return
+    JOBS.submit(message.chat.id, "solve", query, solve_request,
+                session, message, *query)
+
 
 @bot.message_handler(func=lambda message: True, content_types=['photo'])
 def photo(message):
-
+    session = SESSIONS.get(message.chat.id)
+    # the queued queries are on the previous board, and would wait behind
+    # the parsing of the new one: drop them
+    JOBS.cancel(message.chat.id, ("solve", "map"))
+    # the queries sent meanwhile, to any server process, wait for the new board
+    session.start_parsing()
     file_id = message.photo[-1].file_id
-    file_info = bot.get_file(file_id)
-    downloaded_file = bot.download_file(file_info.file_path)
+    JOBS.submit(message.chat.id, "photo", file_id,
+                photo_request, session, message, file_id)
+
 
-    input_image_path = f"{SAVE_DIR}/{message.chat.id}-input.jpg"
+@traced("photo")
+def photo_request(session: ChatSession, message, file_id, cancel):
 
-    # save new image
-    with open(input_image_path, 'wb') as new_file:
-        new_file.write(downloaded_file)
+    board = None
+    failure = "Sorry, I could not download this picture, please send it again"
+    try:
+        file_info = bot.get_file(file_id)
+        downloaded_file = bot.download_file(file_info.file_path)
+
+        # save new image
+        with open(session.input_image_path, 'wb') as new_file:
+            new_file.write(downloaded_file)
+
+        # parse the board once, the queries load the parsed board
+        failure = "Sorry, I could not find the board in this picture, please send another one"
+        board = parse_board(Image.open(io.BytesIO(downloaded_file)))
+    except Exception:
+        app.logger.exception("board extraction failed")
+    finally:
+        # a newer picture was sent meanwhile, its job owns the board and the
+        # parsing marker. Otherwise the marker always ends here, the queries
+        # waiting for it get the new board or no board
+        if not cancel.is_set():
+            session.set_board(board)
+
+    if cancel.is_set():
+        return
+    if board is None:
+        bot.reply_to(message, failure)
+        return
 
     bot.reply_to(
         message, "New board game updated! you can now type queries such as \"GREEN 16 16\" or \"g1616\"")
 
 
-def solve_request(message, input_image_path, output_image_path):
+@traced("solve")
+def solve_request(session: ChatSession, message, color, target_pos, cancel):
 
-    global color
-    global target_pos
+    # board parsed when the picture was received
+    board = session.board(cancel=cancel)
+    if cancel.is_set():
+        # a new picture was sent meanwhile
+        return
+    if board is None:
+        bot.reply_to(
+            message, "There is not previously sent picture of the board, please send a picture")
+        return
 
-    # Load image
-    initial_img = Image.open(input_image_path)
+    # reject the impossible queries before starting any search
+    lower, _ = query_bounds(board, color, target_pos)
+    if lower == UNREACHABLE:
+        bot.reply_to(
+            message, f"The {color.name} bot can never reach case {target_pos[0]+1}, {target_pos[1]+1}")
+        return
+    if lower > MAX_MOVES:
+        bot.reply_to(
+            message, f"No solution found :(\n(At least {lower} moves are needed, more than the {MAX_MOVES} moves explored)")
+        return
 
     bot.reply_to(
         message, f"Starting the solver\n{color.name} bot tries to reach case {target_pos[0]+1}, {target_pos[1]+1}")
 
     # Solve challenge
-    is_solved = solve(initial_img, color=color,
-                      target_pos=target_pos, output_path=output_image_path)
+    result = solve_board(board, color=color, target_pos=target_pos,
+                         output_path=None, rec=MAX_MOVES + 1,
+                         budget=SearchBudget(max_seconds=MAX_SECONDS, cancel=cancel))
 
-    if is_solved:
-        with open(output_image_path, 'rb') as new_file:
-            bot.send_photo(chat_id=message.chat.id, photo=new_file)
+    if result.stop == "cancelled":
+        # superseded by a newer query
+        return
+    elif result.solved:
+        bot.send_photo(chat_id=message.chat.id,
+                       photo=solution_image(board, result.path))
+    elif result.stop == "exhausted":
+        bot.reply_to(
+            message, f"No solution found :(\n(No solution within {result.depth} moves)")
     else:
         bot.reply_to(
-            message, "No solution found :(\n(Max depth exploration: 10)")
+            message, f"No solution found :(\n(Search stopped by the {result.stop} limit, no solution within {result.depth} moves)")
 
 
 @app.route('/' + TOKEN, methods=['POST'])
@@ -131,6 +261,11 @@ def getMessage():
     return "!", 200
 
 
+@app.route("/metrics")
+def metrics():
+    return jsonify({**METRICS.snapshot(), "jobs": len(JOBS)}), 200
+
+
 @app.route("/")
 def webhook():
     bot.remove_webhook()
@@ -192,8 +327,6 @@ def match_query(text: str) -> Tuple[str, int, int]:
 if __name__ == "__main__":
 
     TESTING = False
-    color = Color.YELLOW
-    target_pos = (8, 9)
 
     if TESTING:
         bot.remove_webhook()
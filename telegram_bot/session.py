@@ -0,0 +1,112 @@
+import os
+import threading
+import time
+from typing import Dict, Hashable, Optional, Tuple
+
+from image_extraction.Color import Color
+from main import Board, load_board, save_board
+
+# a parsing marker older than this is left by a crashed process
+MAX_PARSING_SECONDS = 120
+
+
+class ChatSession:
+    """
+    State of a chat: its files, the last parsed board and the last query.
+    The board is stored on disk, shared by all the server processes, and kept
+    in memory until the file changes. A marker file tells the other processes
+    that a new picture is being parsed.
+    """
+
+    def __init__(self, chat_id: Hashable, save_dir: str):
+        self.chat_id = chat_id
+        self.save_dir = save_dir
+        self.lock = threading.Lock()
+        self.query: Optional[Tuple[Color, Tuple[int, int]]] = None
+        self._board: Optional[Board] = None
+        self._board_mtime: Optional[float] = None
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.save_dir, f"{self.chat_id}-{name}")
+
+    @property
+    def input_image_path(self) -> str:
+        return self.path("input.jpg")
+
+    @property
+    def board_path(self) -> str:
+        return self.path("board.npz")
+
+    @property
+    def parsing_path(self) -> str:
+        return self.path("parsing")
+
+    def has_board(self) -> bool:
+        return os.path.isfile(self.board_path) or self.is_parsing()
+
+    def is_parsing(self) -> bool:
+        try:
+            return time.time() - os.path.getmtime(self.parsing_path) < MAX_PARSING_SECONDS
+        except FileNotFoundError:
+            return False
+
+    def start_parsing(self):
+        open(self.parsing_path, "w").close()
+
+    def set_board(self, board: Optional[Board]):
+        """
+        Replace the board of the chat (None to drop it), and end the parsing
+        """
+        with self.lock:
+            if board is None:
+                if os.path.isfile(self.board_path):
+                    os.remove(self.board_path)
+            else:
+                # write then rename, the other processes never load a partial file
+                tmp_path = self.path(f"board.{os.getpid()}.tmp.npz")
+                save_board(board, tmp_path)
+                os.replace(tmp_path, self.board_path)
+            self._board = board
+            self._board_mtime = None if board is None else os.path.getmtime(self.board_path)
+            try:
+                os.remove(self.parsing_path)
+            except FileNotFoundError:
+                pass
+
+    def board(self, timeout: float = 60, cancel: Optional[threading.Event] = None) -> Optional[Board]:
+        """
+        Board of the chat, waits for the picture being parsed (at most
+        timeout seconds, or until cancel is set), None if there is no board
+        """
+        cancel = cancel or threading.Event()
+        start_time = time.time()
+        while self.is_parsing() and time.time() - start_time < timeout:
+            if cancel.wait(.1):
+                break
+
+        with self.lock:
+            if not os.path.isfile(self.board_path):
+                return None
+            mtime = os.path.getmtime(self.board_path)
+            if self._board is None or mtime != self._board_mtime:
+                self._board = load_board(self.board_path)
+                self._board_mtime = mtime
+            return self._board
+
+
+class SessionStore:
+    """
+    Thread safe registry of the ChatSession of each chat
+    """
+
+    def __init__(self, save_dir: str):
+        self.save_dir = save_dir
+        self.lock = threading.Lock()
+        self.sessions: Dict[Hashable, ChatSession] = {}
+        os.makedirs(save_dir, exist_ok=True)
+
+    def get(self, chat_id: Hashable) -> ChatSession:
+        with self.lock:
+            if chat_id not in self.sessions:
+                self.sessions[chat_id] = ChatSession(chat_id, self.save_dir)
+            return self.sessions[chat_id]
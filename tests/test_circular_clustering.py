@@ -0,0 +1,33 @@
+import random
+
+import numpy as np
+import pytest
+
+from tools.circular_clustering import circular_groups
+from tools.geometry import angular_dist_modulo
+from tools.kruskal import kruskal_groups
+
+
+def random_angles(rnd: random.Random, n: int):
+    kind = rnd.random()
+    if kind < .5:
+        # quantized float32 angles, as returned by HoughLines
+        return list((np.array([rnd.randrange(180) for _ in range(n)]) * np.float32(np.pi/180)).astype(np.float32))
+    if kind < .7:
+        return list(np.float32(rnd.choice([10, 55, 100])*np.pi/180) + np.zeros(n, np.float32))
+    return [rnd.uniform(0, np.pi) for _ in range(n)]
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_same_groups_as_kruskal(seed):
+    rnd = random.Random(seed)
+    data = random_angles(rnd, rnd.randint(1, 40))
+    period = rnd.choice([np.pi/2, np.pi])
+    nb_groups = rnd.choice([1, 2, 3])
+    d_max = rnd.choice([float("inf"), 1*np.pi/180, 3*np.pi/180, 30*np.pi/180])
+
+    expected = kruskal_groups(data, lambda a, b: angular_dist_modulo(a, b, angle=period),
+                              nb_groups, d_max)
+    groups = circular_groups(data, period, nb_groups, d_max)
+
+    assert [[float(x) for x in gp] for gp in groups] == [[float(x) for x in gp] for gp in expected]
@@ -0,0 +1,113 @@
+from array import array
+from multiprocessing.shared_memory import SharedMemory
+from typing import Optional
+
+
+class VisitedTable:
+    """
+    Open addressing hash table (linear probing) from non zero 32 bits integers
+    to 1 byte values, stored in two preallocated arrays: 5 bytes per slot
+    instead of the ~200 bytes of a dict entry, and no hash collision.
+    With shared=True, the keys are stored in shared memory so that other
+    processes can look them up (see attach).
+    """
+
+    def __init__(self, capacity: int = 1 << 16, max_load: float = .75, shared: bool = False):
+        self.max_load = max_load
+        self.size = 0
+        self.shm = None
+        self.shared = shared
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int):
+        self.bits = max(capacity - 1, 1).bit_length()
+        self.capacity = 1 << self.bits
+        if self.shared:
+            self.shm = SharedMemory(create=True, size=4*self.capacity)
+            self.keys = self.shm.buf.cast("I")
+        else:
+            self.keys = array("I", [0]) * self.capacity
+        self.values = bytearray(self.capacity)
+        self.max_size = int(self.capacity * self.max_load)
+
+    @classmethod
+    def attach(cls, name: str, capacity: int) -> "VisitedTable":
+        """
+        Read only access to the keys of a shared table of another process,
+        from its shm.name and capacity. Values are not shared.
+        """
+        table = cls.__new__(cls)
+        table.shared = False
+        table.shm = SharedMemory(name=name)
+        table.keys = table.shm.buf.cast("I")
+        table.bits = capacity.bit_length() - 1
+        table.capacity = capacity
+        table.values = None
+        return table
+
+    def close(self, unlink: bool = True):
+        """
+        Free the shared memory of the table, the owner unlinks it
+        """
+        if self.shm is not None:
+            self.keys.release()
+            self.shm.close()
+            if unlink:
+                self.shm.unlink()
+            self.shm = None
+
+    def _slot(self, key: int) -> int:
+        keys = self.keys
+        mask = self.capacity - 1
+        # Fibonacci hashing, keeps the high bits of the product
+        slot = ((key * 0x9E3779B1) & 0xFFFFFFFF) >> (32 - self.bits)
+        while keys[slot] and keys[slot] != key:
+            slot = (slot + 1) & mask
+        return slot
+
+    def add(self, key: int, value: int) -> bool:
+        """
+        Insert the key if not already present, returns whether it was inserted
+        """
+        keys = self.keys
+        mask = self.capacity - 1
+        slot = ((key * 0x9E3779B1) & 0xFFFFFFFF) >> (32 - self.bits)
+        while keys[slot]:
+            if keys[slot] == key:
+                return False
+            slot = (slot + 1) & mask
+        keys[slot] = key
+        self.values[slot] = value
+        self.size += 1
+        if self.size > self.max_size:
+            self._grow()
+        return True
+
+    def get(self, key: int, default: Optional[int] = None) -> Optional[int]:
+        slot = self._slot(key)
+        if self.keys[slot]:
+            return self.values[slot]
+        return default
+
+    def _grow(self):
+        keys, values, shm = self.keys, self.values, self.shm
+        self._allocate(2*self.capacity)
+        for key, value in zip(keys, values):
+            if key:
+                slot = self._slot(key)
+                self.keys[slot] = key
+                self.values[slot] = value
+        if shm is not None:
+            keys.release()
+            shm.close()
+            shm.unlink()
+
+    @property
+    def nbytes(self) -> int:
+        return self.keys.itemsize*self.capacity + len(self.values)
+
+    def __contains__(self, key: int) -> bool:
+        return bool(self.keys[self._slot(key)])
+
+    def __len__(self) -> int:
+        return self.size
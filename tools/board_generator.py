@@ -0,0 +1,92 @@
+import random
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from image_extraction.Color import Color
+from image_extraction.Wall import Wall
+
+GRID_SIZE = 16
+CENTER = range(7, 9)
+
+OPPOSITE = {Wall.TOP: Wall.BOTTOM, Wall.BOTTOM: Wall.TOP,
+            Wall.LEFT: Wall.RIGHT, Wall.RIGHT: Wall.LEFT}
+STEPS = {Wall.TOP: (-1, 0), Wall.BOTTOM: (1, 0),
+         Wall.LEFT: (0, -1), Wall.RIGHT: (0, 1)}
+CORNERS = [(Wall.TOP, Wall.LEFT), (Wall.TOP, Wall.RIGHT),
+           (Wall.BOTTOM, Wall.LEFT), (Wall.BOTTOM, Wall.RIGHT)]
+
+
+def empty_grid() -> np.ndarray:
+    """
+    Grid with the outer walls and the walls of the center square,
+    as returned by get_wall_grid
+    """
+    grid = np.zeros((GRID_SIZE, GRID_SIZE), dtype=np.uint8)
+    grid[0, :] |= Wall.TOP
+    grid[-1, :] |= Wall.BOTTOM
+    grid[:, 0] |= Wall.LEFT
+    grid[:, -1] |= Wall.RIGHT
+    grid[7:9, 7:9] |= Wall.TOP | Wall.BOTTOM | Wall.LEFT | Wall.RIGHT
+    grid[7:9, 6] |= Wall.RIGHT
+    grid[7:9, 9] |= Wall.LEFT
+    grid[6, 7:9] |= Wall.BOTTOM
+    grid[9, 7:9] |= Wall.TOP
+    return grid
+
+
+def add_wall(grid: np.ndarray, i: int, j: int, wall: Wall):
+    """
+    Add a wall on a side of the case, and on the facing side of its neighbour
+    """
+    grid[i, j] |= wall
+    di, dj = STEPS[wall]
+    if 0 <= i + di < GRID_SIZE and 0 <= j + dj < GRID_SIZE:
+        grid[i + di, j + dj] |= OPPOSITE[wall]
+
+
+def random_grid(rnd: random.Random, nb_corners: int = 4, nb_side_walls: int = 2) -> np.ndarray:
+    """
+    Random board in the layout of the game: in each quarter, nb_corners
+    target cases with two walls in L (never next to each other) and
+    nb_side_walls walls on the outer sides
+    """
+    grid = empty_grid()
+    half = GRID_SIZE // 2
+    for top in (0, half):
+        for left in (0, half):
+            cases = [(i, j) for i in range(top + 1, top + half - 1) for j in range(left + 1, left + half - 1)
+                     if not (i in CENTER and j in CENTER)]
+            rnd.shuffle(cases)
+            corners: List[Tuple[int, int]] = []
+            for i, j in cases:
+                if len(corners) == nb_corners:
+                    break
+                if all(abs(i - k) + abs(j - l) > 2 for k, l in corners):
+                    corners.append((i, j))
+                    for wall in rnd.choice(CORNERS):
+                        add_wall(grid, i, j, wall)
+
+            sides = [(top if top == 0 else GRID_SIZE - 1, left + rnd.randrange(1, half - 1), Wall.RIGHT),
+                     (top + rnd.randrange(1, half - 1), left if left == 0 else GRID_SIZE - 1, Wall.BOTTOM)]
+            for i, j, wall in sides[:nb_side_walls]:
+                add_wall(grid, i, j, wall)
+
+    return grid
+
+
+def random_state(rnd: random.Random, grid_size: int = GRID_SIZE) -> Dict[Color, Tuple[int, int]]:
+    """
+    Distinct random positions of the robots, out of the center square
+    """
+    cases = [(i, j) for i in range(grid_size) for j in range(grid_size)
+             if not (i in CENTER and j in CENTER)]
+    return dict(zip(Color, rnd.sample(cases, len(Color))))
+
+
+def random_board(seed: Optional[int] = None) -> Tuple[np.ndarray, Dict[Color, Tuple[int, int]]]:
+    """
+    Wall grid and robots positions of a random board, the same for a given seed
+    """
+    rnd = random.Random(seed)
+    return random_grid(rnd), random_state(rnd)
@@ -0,0 +1,61 @@
+from typing import Iterable, List
+
+import numpy as np
+
+NEIGHBOURS = 3
+
+
+def circular_groups(data: Iterable[float], period: float, nb_groups: int,
+                    d_max: float = float("inf")) -> List[List[float]]:
+    """
+    Same groups as kruskal_groups(data, lambda a, b: angular_dist_modulo(a, b, angle=period),
+    nb_groups, d_max) in O(n log n) for data in [0, 2*period), as the angles of
+    HoughLines in [0, pi) with period pi/2 or pi: the groups of points on a
+    circle are arcs of the sorted points, so only the distances between
+    neighbours are merged (in the order of kruskal_groups, ties included).
+    With more values on the same point modulo period, the groups may differ
+    """
+
+    n = len(data)
+    if n <= nb_groups:
+        return [[x] for x in data]
+
+    values = np.asarray(data)
+    # equal values, merged first, each one to the first of its value
+    _, first, inverse = np.unique(values, return_index=True, return_inverse=True)
+    edges = [(0., i, first[inverse[i]]) for i in range(n) if first[inverse[i]] != i]
+
+    # neighbour values on the circle, linked by their first elements. A few
+    # neighbours each, as the rounding of the (at most two) values equal
+    # modulo the period may make the second neighbour closer than the first one
+    order = np.argsort(values[first] % period, kind="stable")
+    for shift in range(1, min(NEIGHBOURS, len(first) - 1) + 1):
+        a, b = first[order], first[np.roll(order, -shift)]
+        high, low = np.maximum(a, b), np.minimum(a, b)
+        # as in angular_dist_modulo on the scalars: modulo in float64
+        diff = (values[high] - values[low]).astype(np.float64)
+        dists = np.minimum(diff % period, period - diff % period)
+        edges += zip(dists.tolist(), high.tolist(), low.tolist())
+
+    parent = list(range(n))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    current_nb_groups = n
+    for d, i, j in sorted(edges):
+        if d > d_max or current_nb_groups == nb_groups:
+            break
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[root_i] = root_j
+            current_nb_groups -= 1
+
+    groups = {}
+    for i in range(n):
+        groups.setdefault(find(i), []).append(data[i])
+
+    return [x[1] for x in sorted((-len(gp), gp) for gp in groups.values())]
@@ -0,0 +1,117 @@
+import contextlib
+import cProfile
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional
+
+# directory of the cProfile dumps of profiled, disabled if not set
+PROFILE_DIR = os.environ.get("PROFILE_DIR")
+
+
+class Metrics:
+    """
+    Thread safe registry of the durations of the pipeline stages (count,
+    total and max seconds) and of counters (e.g. BFS nodes per level)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings: Dict[str, Dict[str, float]] = {}
+        self.counters: Dict[str, int] = {}
+
+    def add_time(self, name: str, seconds: float):
+        with self.lock:
+            timing = self.timings.setdefault(
+                name, {"count": 0, "total": 0., "max": 0.})
+            timing["count"] += 1
+            timing["total"] += seconds
+            timing["max"] = max(timing["max"], seconds)
+
+    def count(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            timings = {name: {**timing, "mean": timing["total"] / timing["count"]}
+                       for name, timing in self.timings.items()}
+            return {"timings": timings, "counters": dict(self.counters)}
+
+    def reset(self):
+        with self.lock:
+            self.timings.clear()
+            self.counters.clear()
+
+
+METRICS = Metrics()
+
+# stages of the current trace of each thread
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def timer(name: str) -> Iterator[None]:
+    """
+    Time the block, in METRICS and in the trace of the thread if any
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start_time
+        METRICS.add_time(name, seconds)
+        stages = getattr(_local, "stages", None)
+        if stages is not None:
+            stages[name] = stages.get(name, 0.) + seconds
+
+
+@contextlib.contextmanager
+def trace() -> Iterator[Dict[str, float]]:
+    """
+    Collect the durations of the timers run by this thread in the block
+    (also added to the enclosing trace)
+    """
+    previous = getattr(_local, "stages", None)
+    stages: Dict[str, float] = {}
+    _local.stages = stages
+    try:
+        yield stages
+    finally:
+        _local.stages = previous
+        if previous is not None:
+            for name, seconds in stages.items():
+                previous[name] = previous.get(name, 0.) + seconds
+
+
+def count(name: str, value: int = 1):
+    METRICS.count(name, value)
+
+
+def count_level(search: str, depth: int, nodes: int):
+    """
+    Count the nodes of a level of a BFS
+    """
+    METRICS.count(f"{search}.level_{depth}", nodes)
+
+
+@contextlib.contextmanager
+def profiled(name: str, directory: Optional[str] = None) -> Iterator[Optional[cProfile.Profile]]:
+    """
+    Run the block under cProfile and dump the stats in directory/name-<time>.prof
+    (see pstats), only if directory or PROFILE_DIR is set
+    """
+    directory = directory or PROFILE_DIR
+    if directory is None:
+        yield None
+        return
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        os.makedirs(directory, exist_ok=True)
+        profile.dump_stats(os.path.join(
+            directory, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{threading.get_ident()}.prof"))